@@ -0,0 +1,66 @@
+# Микробенчмарк разбора webhook до того вида, в котором апдейт получает диспетчер:
+# request.json() + types.Update(**data) + "перемонтирование" к боту, которое делает feed_update
+# для апдейта без бота, против types.Update.model_validate_json(body, context={"bot": bot})
+#
+# Запуск: python bench/ingest.py [--number 2000] [--samples bench/samples/updates.json]
+import argparse
+import json
+import time
+from pathlib import Path
+
+from aiogram import Bot, types
+
+SAMPLES_PATH = Path(__file__).parent / "samples" / "updates.json"
+# Сеть не используется: бот нужен только как контекст модели
+BOT = Bot(token="42:BENCHMARK")
+
+def load_samples(path: Path) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        updates = json.load(f)
+    # Тела запросов в том виде, в котором их присылает Telegram
+    return [json.dumps(update, ensure_ascii=False).encode("utf-8") for update in updates]
+
+def parse_dict(body: bytes) -> types.Update:
+    # Прежний путь webhook_handler: JSON -> dict -> pydantic,
+    # затем то же, что Dispatcher.feed_update делает при update.bot != bot
+    data = json.loads(body)
+    update = types.Update(**data)
+    return types.Update.model_validate(update.model_dump(), context={"bot": BOT})
+
+def parse_bytes(body: bytes) -> types.Update:
+    # Новый путь: один проход pydantic по байтам сразу с ботом, feed_update ничего не переделывает
+    return types.Update.model_validate_json(body, context={"bot": BOT})
+
+def measure(parse, bodies: list, number: int) -> float:
+    # Прогрев: первая валидация строит схему модели
+    for body in bodies:
+        parse(body)
+    started = time.perf_counter()
+    for _ in range(number):
+        for body in bodies:
+            parse(body)
+    elapsed = time.perf_counter() - started
+    return elapsed / (number * len(bodies))
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк разбора апдейтов webhook")
+    parser.add_argument("--number", type=int, default=2000, help="Число проходов по выборке")
+    parser.add_argument("--samples", type=Path, default=SAMPLES_PATH, help="JSON-файл со списком апдейтов")
+    args = parser.parse_args()
+
+    bodies = load_samples(args.samples)
+    for body in bodies:
+        old, new = parse_dict(body), parse_bytes(body)
+        if old.model_dump() != new.model_dump() or new.bot is not BOT:
+            raise SystemExit("Результаты разбора расходятся")
+
+    results = {
+        "dict": measure(parse_dict, bodies, args.number),
+        "bytes": measure(parse_bytes, bodies, args.number),
+    }
+    for name, per_update in results.items():
+        print(f"{name:>6}: {per_update * 1e6:8.2f} мкс/апдейт, {1 / per_update:10.0f} апдейтов/с")
+    print(f"Ускорение: x{results['dict'] / results['bytes']:.2f}")
+
+if __name__ == "__main__":
+    main()
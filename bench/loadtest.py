@@ -0,0 +1,488 @@
+# Нагрузочный тест бота без обращения к продакшену
+#
+# Скрипт поднимает две локальные заглушки — Bot API (sendMessage, editMessageText,
+# getChatMember, ...) и CLAUDE_API_URL с настраиваемой задержкой и потоковым режимом, —
+# запускает bot.py отдельным процессом (тот же main(), что и в проде) и проигрывает
+# синтетические сценарии в /webhook. Каждый виртуальный пользователь ждет ответа бота
+# перед следующим шагом: первого sendMessage/editMessageText в свой чат, а для вопросов
+# к нейросети — сообщения с полным текстом ответа. Для вопросов отдельно замеряются
+# первый ответ (заглушка "…"), первый текст модели и полный ответ.
+#
+# Запуск:
+#   python bench/loadtest.py --scenario mixed --users 500 --concurrency 50 --output bench/results/run.json
+#   python bench/loadtest.py --scenario start_storm --env DISPATCH_MODE=queue --compare bench/results/run.json
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+
+ROOT = Path(__file__).resolve().parent.parent
+BOT_TOKEN = "123456:LOADTEST-fake-token"
+CHANNEL_ID = "@loadtest_channel"
+USER_ID_BASE = 10_000_000
+QUESTIONS = (
+    "Как взять кредит без отказа?",
+    "Что такое ОСАГО?",
+    "Как улучшить кредитную историю?",
+    "Какую кредитную карту выбрать?",
+    "Как рефинансировать ипотеку?",
+)
+# Ответ заглушки нейросети: "слово0 слово1 ... словоN"
+ANSWER_WORD = "слово"
+# Сценарии: последовательность шагов виртуального пользователя
+SCENARIOS = {
+    "start_storm": [("message", "/start")],
+    "menu": [
+        ("message", "/menu"),
+        ("callback", "credit_cards"),
+        ("callback", "back"),
+        ("callback", "loans"),
+        ("callback", "back"),
+    ],
+    "ask_neuro": [
+        ("message", "/start"),
+        ("callback", "ask_neuro"),
+        ("question", None),
+        ("question", None),
+    ],
+}
+MIXED_WEIGHTS = {"start_storm": 0.3, "menu": 0.5, "ask_neuro": 0.2}
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(q / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def summarize(values: list) -> dict:
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else 0.0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else 0.0,
+    }
+
+
+# Ожидание ответов бота на один шаг сценария; отметки времени ставит заглушка Bot API
+class StepWaiter:
+    def __init__(self, step: int, final_marker: str = None):
+        self.step = step
+        # Текст, по которому ответ нейросети считается полным (None — шаг без нейросети)
+        self.final_marker = final_marker
+        self.response_at = None
+        self.first_token_at = None
+        self.final_at = None
+        self.done = asyncio.Event()
+
+    def observe(self, text: str):
+        now = time.perf_counter()
+        if self.response_at is None:
+            self.response_at = now
+        if self.final_marker is None:
+            self.done.set()
+            return
+        if self.first_token_at is None and ANSWER_WORD in text:
+            self.first_token_at = now
+        if self.final_marker in text:
+            self.final_at = now
+            self.done.set()
+
+
+# Заглушка Bot API
+class FakeTelegram:
+    def __init__(self):
+        # Не пересекается с message_id из апдейтов UpdateFactory (колбэки ссылаются на message_id=1)
+        self.message_id = 1_000_000
+        self.calls = {}
+        # chat_id -> StepWaiter текущего шага пользователя
+        self.waiters = {}
+        # message_id -> шаг, в котором бот отправил сообщение: поздние правки
+        # ответа на прошлый вопрос не должны засчитываться следующему шагу
+        self.owners = {}
+        self.stale_edits = 0
+
+    def _message(self, chat_id, text=""):
+        self.message_id += 1
+        return {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": 123456, "is_bot": True, "first_name": "bot"},
+            "text": text or "…",
+        }
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        chat_id = params.get("chat_id")
+        waiter = self.waiters.get(str(chat_id))
+        if method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, params.get("text", ""))
+            if method == "sendMessage" and waiter is not None:
+                self.owners[result["message_id"]] = waiter.step
+            owner = self.owners.get(int(params.get("message_id") or 0))
+            if method == "editMessageText" and owner is not None and waiter is not None and owner != waiter.step:
+                self.stale_edits += 1
+            elif waiter is not None:
+                waiter.observe(params.get("text", ""))
+        elif method == "copyMessage":
+            self.message_id += 1
+            result = {"message_id": self.message_id}
+            if waiter is not None:
+                waiter.observe("")
+        elif method == "getChatMember":
+            result = {
+                "status": "member",
+                "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "user"},
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+
+# Заглушка нейросети (формат chat/completions, в том числе stream: true)
+class FakeLLM:
+    def __init__(self, latency: float, chunks: int, chunk_delay: float):
+        self.latency = latency
+        self.chunks = chunks
+        self.chunk_delay = chunk_delay
+        self.requests = 0
+
+    async def handle(self, request):
+        self.requests += 1
+        payload = await request.json()
+        await asyncio.sleep(self.latency)
+        words = [f"слово{i} " for i in range(self.chunks)]
+        if not payload.get("stream"):
+            return web.json_response({"choices": [{"message": {"role": "assistant", "content": "".join(words)}}]})
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in words:
+            event = {"choices": [{"delta": {"content": word}}]}
+            await response.write(b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n\n")
+            await asyncio.sleep(self.chunk_delay)
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/chat/completions", self.handle)
+        return app
+
+
+# Генерация апдейтов
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+        self.message_id = 0
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "language_code": "ru"}
+
+    def _chat(self, user_id: int) -> dict:
+        return {"id": user_id, "type": "private", "first_name": f"user{user_id}"}
+
+    def message(self, user_id: int, text: str) -> dict:
+        self.update_id += 1
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id,
+            "from": self._user(user_id),
+            "chat": self._chat(user_id),
+            "date": int(time.time()),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"offset": 0, "length": len(text.split()[0]), "type": "bot_command"}]
+        return {"update_id": self.update_id, "message": message}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        self.update_id += 1
+        return {
+            "update_id": self.update_id,
+            "callback_query": {
+                "id": str(self.update_id),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": 1,
+                    "from": {"id": 123456, "is_bot": True, "first_name": "bot"},
+                    "chat": self._chat(user_id),
+                    "date": int(time.time()),
+                    "text": "🏠 Главное меню",
+                },
+            },
+        }
+
+
+class LoadTest:
+    def __init__(self, args, telegram: FakeTelegram):
+        self.args = args
+        self.telegram = telegram
+        self.factory = UpdateFactory()
+        self.webhook_latency = []
+        self.response_latency = []
+        # Только шаги с вопросом к нейросети
+        self.first_token_latency = []
+        self.answer_latency = []
+        self.steps = 0
+        self.questions = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.sent = 0
+
+    def _script(self, scenario: str, rng: random.Random) -> list:
+        if scenario == "mixed":
+            names = list(MIXED_WEIGHTS)
+            scenario = rng.choices(names, weights=[MIXED_WEIGHTS[name] for name in names])[0]
+        return SCENARIOS[scenario]
+
+    def _question(self, rng: random.Random) -> str:
+        # По умолчанию вопросы уникальны, чтобы замер шел мимо кэша ответов и склейки запросов
+        self.questions += 1
+        question = rng.choice(QUESTIONS)
+        return question if self.args.repeat_questions else f"{question} (№{self.questions})"
+
+    async def _step(self, session: aiohttp.ClientSession, user_id: int, update: dict, question: bool = False):
+        self.steps += 1
+        final_marker = f"{ANSWER_WORD}{self.args.llm_chunks - 1}" if question else None
+        waiter = self.telegram.waiters[str(user_id)] = StepWaiter(self.steps, final_marker)
+        body = json.dumps(update, ensure_ascii=False).encode("utf-8")
+        started = time.perf_counter()
+        try:
+            async with session.post(
+                self.args.webhook_url,
+                data=body,
+                headers={
+                    "Content-Type": "application/json",
+                    "X-Telegram-Bot-Api-Secret-Token": self.args.secret,
+                },
+            ) as response:
+                await response.read()
+                self.webhook_latency.append(time.perf_counter() - started)
+                self.sent += 1
+                if response.status != 200:
+                    self.errors += 1
+                    return
+            await asyncio.wait_for(waiter.done.wait(), timeout=self.args.timeout)
+            self.response_latency.append(waiter.response_at - started)
+            if question:
+                self.first_token_latency.append((waiter.first_token_at or waiter.final_at) - started)
+                self.answer_latency.append(waiter.final_at - started)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+        except aiohttp.ClientError:
+            self.errors += 1
+        finally:
+            self.telegram.waiters.pop(str(user_id), None)
+
+    async def _user(self, session, semaphore, index: int, rng: random.Random):
+        user_id = USER_ID_BASE + index
+        async with semaphore:
+            for kind, value in self._script(self.args.scenario, rng):
+                if kind == "message":
+                    update = self.factory.message(user_id, value)
+                elif kind == "callback":
+                    update = self.factory.callback(user_id, value)
+                else:
+                    update = self.factory.message(user_id, self._question(rng))
+                await self._step(session, user_id, update, question=kind == "question")
+
+    async def run(self) -> float:
+        rng = random.Random(self.args.seed)
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.args.concurrency)
+        started = time.perf_counter()
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await asyncio.gather(*(
+                self._user(session, semaphore, index, rng) for index in range(self.args.users)
+            ))
+        return time.perf_counter() - started
+
+
+async def start_site(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+def start_bot(args, workdir: Path) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "API_TOKEN": BOT_TOKEN,
+        "CHANNEL_ID": CHANNEL_ID,
+        "ADMIN_IDS": "",
+        "PORT": str(args.bot_port),
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{args.telegram_port}",
+        "CLAUDE_API_KEY": "loadtest",
+        "CLAUDE_API_URL": f"http://127.0.0.1:{args.llm_port}/chat/completions",
+        "DATABASE_URL": f"sqlite:///{workdir / 'users.db'}",
+        "LOG_FILE": str(workdir / "bot.log"),
+        "LOG_LEVEL": "WARNING",
+        "WEBHOOK_SECRET": args.secret,
+        "WEBHOOK_URL": f"http://127.0.0.1:{args.bot_port}/webhook",
+        # Нагрузочный тест не должен упираться в лимиты вопросов и кэш подписки
+        "QUOTA_LIMIT_USER": "",
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    log = open(workdir / "bot.stdout", "w", encoding="utf-8")
+    return subprocess.Popen(
+        [sys.executable, str(ROOT / "bot.py")],
+        cwd=ROOT,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+
+async def wait_ready(port: int, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"bot.py завершился с кодом {process.returncode}")
+            try:
+                async with session.get(f"http://127.0.0.1:{port}/health") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError("bot.py не поднялся за отведенное время")
+
+
+def compare(current: dict, baseline_path: Path, threshold: float) -> bool:
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    ok = True
+    print(f"\nСравнение с {baseline_path}:")
+    for section in ("response_latency", "first_token_latency", "answer_latency", "webhook_latency"):
+        if section not in baseline or not baseline[section]["count"] or not current[section]["count"]:
+            continue
+        for key in ("p50", "p95", "p99"):
+            old, new = baseline[section][key], current[section][key]
+            change = (new - old) / old * 100 if old else 0.0
+            flag = ""
+            if key != "p50" and change > threshold:
+                flag = "  <-- регрессия"
+                ok = False
+            print(f"  {section}.{key}: {old * 1000:.1f} -> {new * 1000:.1f} мс ({change:+.1f}%){flag}")
+    old_rps, new_rps = baseline["throughput"], current["throughput"]
+    change = (new_rps - old_rps) / old_rps * 100 if old_rps else 0.0
+    if change < -threshold:
+        ok = False
+    print(f"  throughput: {old_rps:.1f} -> {new_rps:.1f} апдейтов/с ({change:+.1f}%)")
+    return ok
+
+
+async def run(args) -> dict:
+    telegram = FakeTelegram()
+    llm = FakeLLM(args.llm_latency, args.llm_chunks, args.llm_chunk_delay)
+    runners = [
+        await start_site(telegram.app(), args.telegram_port),
+        await start_site(llm.app(), args.llm_port),
+    ]
+    workdir = Path(tempfile.mkdtemp(prefix="bot-loadtest-"))
+    process = start_bot(args, workdir)
+    try:
+        await wait_ready(args.bot_port, process)
+        test = LoadTest(args, telegram)
+        duration = await test.run()
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        for runner in runners:
+            await runner.cleanup()
+    return {
+        "scenario": args.scenario,
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "env": args.env,
+        "llm": {"latency": args.llm_latency, "chunks": args.llm_chunks, "chunk_delay": args.llm_chunk_delay},
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "duration": duration,
+        "updates": test.sent,
+        "throughput": test.sent / duration if duration else 0.0,
+        "errors": test.errors,
+        "timeouts": test.timeouts,
+        "webhook_latency": summarize(test.webhook_latency),
+        "response_latency": summarize(test.response_latency),
+        "first_token_latency": summarize(test.first_token_latency),
+        "answer_latency": summarize(test.answer_latency),
+        "stale_edits": telegram.stale_edits,
+        "telegram_calls": telegram.calls,
+        "llm_requests": llm.requests,
+        "workdir": str(workdir),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с локальными заглушками Telegram и нейросети")
+    parser.add_argument("--scenario", choices=list(SCENARIOS) + ["mixed"], default="mixed")
+    parser.add_argument("--users", type=int, default=200, help="Число виртуальных пользователей")
+    parser.add_argument("--concurrency", type=int, default=50, help="Одновременно активных пользователей")
+    parser.add_argument("--timeout", type=float, default=30, help="Ожидание ответа бота на шаг, с")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Задержка нейросети до первого токена, с")
+    parser.add_argument("--llm-chunks", type=int, default=40, help="Число фрагментов ответа")
+    parser.add_argument("--llm-chunk-delay", type=float, default=0.02, help="Пауза между фрагментами, с")
+    parser.add_argument("--repeat-questions", action="store_true",
+                        help="Брать вопросы из небольшого набора (замер с попаданиями в кэш ответов)")
+    parser.add_argument("--bot-port", type=int, default=18100)
+    parser.add_argument("--telegram-port", type=int, default=18101)
+    parser.add_argument("--llm-port", type=int, default=18102)
+    parser.add_argument("--secret", default="loadtest-secret")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Дополнительные переменные окружения для bot.py (например DISPATCH_MODE=queue)")
+    parser.add_argument("--output", type=Path, help="Куда сохранить результаты в JSON")
+    parser.add_argument("--compare", type=Path, help="JSON прошлого прогона для поиска регрессий")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Допустимое ухудшение p95/p99 и пропускной способности, %%")
+    args = parser.parse_args()
+    args.webhook_url = f"http://127.0.0.1:{args.bot_port}/webhook"
+
+    result = asyncio.run(run(args))
+    print(json.dumps({key: result[key] for key in (
+        "scenario", "updates", "duration", "throughput", "errors", "timeouts", "llm_requests",
+        "webhook_latency", "response_latency", "first_token_latency", "answer_latency"
+    )}, ensure_ascii=False, indent=2))
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.compare and not compare(result, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,171 @@
 import logging
+import logging.handlers
 import asyncio
+import atexit
+import contextlib
+import contextvars
+import copy
+import queue
+import re
 import aiosqlite
 import signal
-from datetime import datetime
-from aiogram import Bot, Dispatcher, types, F, Router
-from aiogram.filters import Command, CommandStart
+import multiprocessing
+import time
+import random
+import hashlib
+import hmac
+import bisect
+import functools
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from aiogram import Bot, Dispatcher, types, F, Router, BaseMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.filters import Command, CommandStart, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
 from aiohttp import web
 from dotenv import load_dotenv
 import os
 import json
+import string
 from pathlib import Path
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types.update import UpdateTypeLookupError
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter, TelegramForbiddenError, TelegramAPIError
+from pydantic import ValidationError
 import aiohttp  # используется для HTTP-запросов к нейросети
 
 # Загрузка переменных окружения
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    level=getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO),
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(os.getenv("LOG_FILE", "logs/bot.log"), encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# Настройка логирования: event loop только кладет записи в очередь,
+# запись в файл и консоль выполняет фоновый поток QueueListener
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.getenv("LOG_FILE", "logs/bot.log")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+# Ротация: size — по размеру (LOG_MAX_BYTES), time — по времени (LOG_ROTATE_WHEN)
+LOG_ROTATE = os.getenv("LOG_ROTATE", "size").lower()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "midnight")
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))
+# Одинаковые предупреждения и ошибки пишутся не чаще раза в LOG_DEDUP_WINDOW секунд
+LOG_DEDUP_WINDOW = float(os.getenv("LOG_DEDUP_WINDOW", 60))
+LOG_TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+# update_id текущего апдейта для сквозной корреляции записей лога
+update_id_var = contextvars.ContextVar("update_id", default=None)
+
+class CorrelationFilter(logging.Filter):
+    # Выполняется в потоке вызывающего кода, где еще доступен контекст апдейта
+    def filter(self, record):
+        record.update_id = update_id_var.get()
+        return True
+
+_DIGITS_RE = re.compile(r"\d+")
+
+class DedupFilter(logging.Filter):
+    def __init__(self, window: float = LOG_DEDUP_WINDOW, max_keys: int = 1000):
+        super().__init__()
+        self.window = window
+        self.max_keys = max_keys
+        # ключ -> [начало окна, подавлено записей]
+        self._seen = {}
+
+    @staticmethod
+    def _key(record) -> tuple:
+        # Цифры (коды, id, время) не делают ошибку "новой"
+        message = record.getMessage()[:200]
+        return record.name, record.levelno, _DIGITS_RE.sub("#", message)
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING or self.window <= 0:
+            return True
+        key = self._key(record)
+        now = time.monotonic()
+        entry = self._seen.get(key)
+        if entry is not None and now - entry[0] < self.window:
+            entry[1] += 1
+            return False
+        if entry is not None and entry[1]:
+            record.msg = f"{record.getMessage()} (повторялось еще {entry[1]} раз за {self.window:.0f} с)"
+            record.args = None
+        if len(self._seen) >= self.max_keys:
+            self._seen = {k: v for k, v in self._seen.items() if now - v[0] < self.window}
+        self._seen[key] = [now, 0]
+        return True
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+        }
+        update_id = getattr(record, "update_id", None)
+        if update_id is not None:
+            entry["update_id"] = update_id
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # Стандартный prepare форматирует запись в потоке event loop и стирает exc_info,
+    # из-за чего трейсбек попадает в "message". Здесь подставляем только аргументы
+    # сообщения, а трейсбек форматирует formatter в потоке QueueListener
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        return record
+
+_log_listener = None
+
+def setup_logging(log_file: str = None):
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+    log_file = log_file or LOG_FILE
+    os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+    if LOG_ROTATE == "time":
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            log_file, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"
+        )
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(LOG_TEXT_FORMAT)
+    stream_handler = logging.StreamHandler()
+    for handler in (file_handler, stream_handler):
+        handler.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(CorrelationFilter())
+    queue_handler.addFilter(DedupFilter())
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    _log_listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    _log_listener.start()
+
+def stop_logging():
+    global _log_listener
+    if _log_listener is not None:
+        # Дописывает все, что осталось в очереди
+        _log_listener.stop()
+        _log_listener = None
+
+setup_logging()
+atexit.register(stop_logging)
 logger = logging.getLogger(__name__)
 
 # Конфигурация
@@ -35,23 +173,102 @@ API_TOKEN = os.getenv("API_TOKEN")
 CHANNEL_ID = os.getenv("CHANNEL_ID", "@sozvezdie_skidok")
 ADMIN_IDS = [int(id) for id in os.getenv("ADMIN_IDS", "").split(",") if id]
 PORT = int(os.getenv("PORT", 10000))  # Render требует порт 10000
+# Число процессов веб-сервера (больше 1 — воркеры делят порт через SO_REUSEPORT)
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", 1))
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///users.db")
 # Работает только режим webhook (polling не используется)
+# Секрет webhook (заголовок X-Telegram-Bot-Api-Secret-Token) и лимит размера тела запроса
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_BODY = int(os.getenv("WEBHOOK_MAX_BODY", 1024 * 1024))
+# Обработка апдейтов: inline — прямо в запросе webhook, queue — через очередь с воркерами
+DISPATCH_MODE = os.getenv("DISPATCH_MODE", "inline").lower()
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", 16))
+DISPATCH_QUEUE_SIZE = int(os.getenv("DISPATCH_QUEUE_SIZE", 1000))
+# Переполнение очереди: wait — ждать места до DISPATCH_PUT_TIMEOUT, shed — сразу отказывать
+DISPATCH_OVERFLOW = os.getenv("DISPATCH_OVERFLOW", "wait").lower()
+DISPATCH_PUT_TIMEOUT = float(os.getenv("DISPATCH_PUT_TIMEOUT", 5))
+DISPATCH_DEDUP_WINDOW = int(os.getenv("DISPATCH_DEDUP_WINDOW", 10000))
+# Адрес Bot API (локальный telegram-bot-api сервер или заглушка для нагрузочных тестов)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
 CLAUDE_API_KEY = os.getenv("CLAUDE_API_KEY")
 CLAUDE_MODEL = os.getenv("CLAUDE_MODEL", "anthropic/claude-3.5-sonnet")
 CLAUDE_API_URL = os.getenv("CLAUDE_API_URL", "https://proxy.tune.app/chat/completions")
+# Лимиты вопросов к нейросети по ролям (пустое значение — без лимита)
+QUOTA_LIMITS = {
+    "admin": int(os.getenv("QUOTA_LIMIT_ADMIN", "") or -1),
+    "user": int(os.getenv("QUOTA_LIMIT_USER", "5") or -1),
+}
+# Пул соединений и повторы запросов к нейросети
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", 32))
+LLM_KEEPALIVE = float(os.getenv("LLM_KEEPALIVE", 60))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 5))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", 30))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 3))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", 0.5))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", 10))
+# Планировщик: окно одновременных запросов к нейросети, доля окна под длинные запросы
+# администраторов и сколько запрос может ждать слота, прежде чем будет отменен
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 8))
+LLM_ADMIN_CONCURRENCY = int(os.getenv("LLM_ADMIN_CONCURRENCY", 4))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", 20))
+# Потоковые ответы нейросети (SSE) с постепенным редактированием сообщения
+LLM_STREAM = os.getenv("LLM_STREAM", "True").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.5))
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Кэш ответов нейросети: LRU в памяти + (опционально) таблица в SQLite
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 1000))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 86400))
+ANSWER_CACHE_PERSIST = os.getenv("ANSWER_CACHE_PERSIST", "True").lower() in ("1", "true", "yes")
+# Таблица answer_cache: не больше ANSWER_CACHE_DB_SIZE строк, чистка не чаще раза в ANSWER_CACHE_EXPIRE_INTERVAL
+ANSWER_CACHE_DB_SIZE = int(os.getenv("ANSWER_CACHE_DB_SIZE", 100000))
+ANSWER_CACHE_EXPIRE_INTERVAL = float(os.getenv("ANSWER_CACHE_EXPIRE_INTERVAL", 600))
+# Кэш статуса подписки на канал (положительный и отрицательный TTL)
+SUBSCRIPTION_TTL = float(os.getenv("SUBSCRIPTION_TTL", 600))
+SUBSCRIPTION_NEGATIVE_TTL = float(os.getenv("SUBSCRIPTION_NEGATIVE_TTL", 30))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", 100000))
+# Хранилище FSM: TTL неактивных сессий, горячий слой в памяти и период пакетной записи
+FSM_TTL = float(os.getenv("FSM_TTL", 3600))
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", 60))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", 50000))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 1.0))
+FSM_EXPIRE_INTERVAL = float(os.getenv("FSM_EXPIRE_INTERVAL", 300))
+# История диалога в режиме вопросов: бюджет токенов по ролям, сброс после простоя
+# и (опционально) сжатие вытесненных реплик в одно контекстное сообщение
+HISTORY_ENABLED = os.getenv("HISTORY_ENABLED", "True").lower() in ("1", "true", "yes")
+HISTORY_BUDGETS = {
+    "admin": int(os.getenv("HISTORY_BUDGET_ADMIN", 4000)),
+    "user": int(os.getenv("HISTORY_BUDGET_USER", 200)),
+}
+HISTORY_TTL = float(os.getenv("HISTORY_TTL", 900))
+HISTORY_SUMMARY = os.getenv("HISTORY_SUMMARY", "False").lower() in ("1", "true", "yes")
+HISTORY_CHARS_PER_TOKEN = float(os.getenv("HISTORY_CHARS_PER_TOKEN", 3))
+# Рассылка: глобальный темп (лимит Telegram ~30 сообщений/с), пачки, чекпоинты и аренда задачи.
+# Темп общий для всех воркеров: одновременно идет только одна рассылка, остальные ждут в очереди
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", 100))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+BROADCAST_REPORT_INTERVAL = float(os.getenv("BROADCAST_REPORT_INTERVAL", 30))
+BROADCAST_LEASE = float(os.getenv("BROADCAST_LEASE", 60))
+# Защита от флуда: токены на пользователя, общий лимит одновременных запросов к нейросети
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", 1.0))
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", 5))
+FLOOD_IDLE_TTL = float(os.getenv("FLOOD_IDLE_TTL", 300))
+FLOOD_MAX_USERS = int(os.getenv("FLOOD_MAX_USERS", 200000))
+FLOOD_NOTICE_INTERVAL = float(os.getenv("FLOOD_NOTICE_INTERVAL", 10))
+FLOOD_LLM_CONCURRENCY = int(os.getenv("FLOOD_LLM_CONCURRENCY", 20))
+QUOTA_CACHE_SIZE = int(os.getenv("QUOTA_CACHE_SIZE", 100000))
+QUOTA_CACHE_TTL = float(os.getenv("QUOTA_CACHE_TTL", 300))
 
 if not API_TOKEN:
     raise ValueError("API_TOKEN не найден в .env")
 if not CLAUDE_API_KEY:
     raise ValueError("CLAUDE_API_KEY не найден в .env")
 
-# Инициализация бота и диспетчера
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-router = Router()
-dp.include_router(router)
+# Инициализация бота (диспетчер создается после хранилища FSM)
+bot = Bot(
+    token=API_TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
 
 # Состояния FSM
 class Form(StatesGroup):
@@ -76,6 +293,17 @@ class Texts:
         "/start - Перезапустить бота\n"
         "/menu - Главное меню"
     )
+    ADMIN_HELP = (
+        "\nАдмин-команды:\n"
+        "/stats - Статистика\n"
+        "/reload - Обновить конфиг\n"
+        "/purge_cache - Очистить кэш ответов\n"
+        "/broadcast текст - Рассылка (или ответом на сообщение)\n"
+        "/broadcast_status - Ход рассылок\n"
+        "/broadcast_cancel id - Отменить рассылку"
+    )
+    FLOOD = "⏳ Слишком много запросов, подождите немного."
+    LLM_BUSY = "⏳ Нейросеть сейчас перегружена, попробуйте через минуту."
     MENU = (
         "🏠 Главное меню:\n"
         "💳 Кредитные карты\n"
@@ -86,68 +314,1330 @@ class Texts:
         "🤖 Спросить нейросеть (требуется подписка на канал)"
     )
 
+# Метрики в текстовом формате Prometheus (каждый процесс отдает свои значения)
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.5))
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(labels: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape_label(value)}"' for name, value in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Metrics:
+    def __init__(self, buckets: tuple = METRICS_BUCKETS):
+        self.buckets = buckets
+        # name -> (тип, описание)
+        self._meta = {}
+        # name -> {labels: значение}; для гистограмм значение — [счетчики корзин, сумма, количество]
+        self._values = {}
+        self._callbacks = []
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+        self._values.setdefault(name, {})
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self._values.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        self._values.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        series = self._values.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            histogram[0][index] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+    def collect(self, callback):
+        # callback(metrics) вызывается перед каждой выдачей /metrics (для значений-снимков)
+        self._callbacks.append(callback)
+
+    def render(self) -> str:
+        for callback in self._callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error(f"Ошибка сбора метрик: {str(e)}")
+        lines = []
+        for name, series in self._values.items():
+            kind, help_text = self._meta.get(name, ("untyped", ""))
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series.items():
+                if kind != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    bucket_labels = _format_labels(labels, f'le="{bound}"')
+                    lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                bucket_labels = _format_labels(labels, 'le="+Inf"')
+                lines.append(f"{name}_bucket{bucket_labels} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+                lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "histogram", "Время работы обработчиков aiogram")
+metrics.describe("bot_db_query_seconds", "histogram", "Время запросов к SQLite по методам Database")
+metrics.describe("bot_llm_request_seconds", "histogram", "Время запросов к нейросети")
+metrics.describe("bot_updates_total", "counter", "Принятые апдейты по типам")
+metrics.describe("bot_event_loop_lag_seconds", "histogram", "Задержка event loop")
+
+def timed(metric: str, label: str = "name"):
+    # Декоратор корутин: гистограмма времени с меткой имени функции и статуса
+    def decorator(func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            status = "ok"
+            try:
+                return await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                status = "cancelled"
+                raise
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                metrics.observe(metric, time.perf_counter() - started, **{label: name, "status": status})
+        return wrapper
+    return decorator
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Внутренний middleware роутера: data["handler"] — уже выбранный обработчик
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        status = "ok"
+        try:
+            return await handler(event, data)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=name, status=status)
+
+async def monitor_loop_lag(interval: float = None):
+    interval = interval or LOOP_LAG_INTERVAL
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(time.perf_counter() - started - interval, 0.0)
+        metrics.observe("bot_event_loop_lag_seconds", lag)
+
 # База данных
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",
+)
+# Размер кэша подготовленных выражений sqlite3 (SQL-строки ниже — константы, поэтому переиспользуются)
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", 256))
+# Отложенная запись (write-behind): новые пользователи и счетчики копятся в памяти
+# и сбрасываются одной транзакцией по размеру очереди или по таймеру
+DB_WRITE_BEHIND = os.getenv("DB_WRITE_BEHIND", "False").lower() in ("1", "true", "yes")
+DB_FLUSH_SIZE = int(os.getenv("DB_FLUSH_SIZE", 500))
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", 1.0))
+
+def _sqlite_path(url: str) -> str:
+    # DATABASE_URL задается в формате sqlite:///users.db, aiosqlite ожидает путь к файлу
+    for prefix in ("sqlite:///", "sqlite://"):
+        if url.startswith(prefix):
+            return url[len(prefix):] or ":memory:"
+    return url
+
 class Database:
-    def __init__(self, db_path: str = None):
-        self.db_path = db_path or DATABASE_URL
+    SQL_CREATE_USERS = '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            subscribed BOOLEAN DEFAULT FALSE,
+            questions_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            blocked BOOLEAN DEFAULT FALSE
+        )
+    '''
+    SQL_USERS_COLUMNS = "SELECT name FROM pragma_table_info('users')"
+    SQL_ADD_BLOCKED_COLUMN = "ALTER TABLE users ADD COLUMN blocked BOOLEAN DEFAULT FALSE"
+    # Повторный /start снимает отметку о блокировке бота
+    SQL_ADD_USER = '''
+        INSERT INTO users (user_id) VALUES (?)
+        ON CONFLICT(user_id) DO UPDATE SET blocked = FALSE WHERE blocked
+    '''
+    SQL_UPDATE_SUBSCRIPTION = '''
+        INSERT INTO users (user_id, subscribed) VALUES (?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET subscribed = excluded.subscribed
+    '''
+    SQL_GET_SUBSCRIPTION = "SELECT subscribed FROM users WHERE user_id = ?"
+    SQL_INCREMENT_QUESTIONS = "UPDATE users SET questions_count = questions_count + 1 WHERE user_id = ?"
+    SQL_ADD_QUESTIONS = "UPDATE users SET questions_count = questions_count + ? WHERE user_id = ?"
+    SQL_GET_QUESTIONS = "SELECT questions_count FROM users WHERE user_id = ?"
+    # Проверка лимита и инкремент одним атомарным выражением (строки нет — значит лимит исчерпан)
+    SQL_CONSUME_QUESTION = '''
+        INSERT INTO users (user_id, questions_count) VALUES (?, 1)
+        ON CONFLICT(user_id) DO UPDATE SET questions_count = questions_count + 1
+        WHERE questions_count < ?
+        RETURNING questions_count
+    '''
+    SQL_REFUND_QUESTION = '''
+        UPDATE users SET questions_count = questions_count - 1
+        WHERE user_id = ? AND questions_count > 0
+        RETURNING questions_count
+    '''
+    SQL_CREATE_ANSWER_CACHE = '''
+        CREATE TABLE IF NOT EXISTS answer_cache (
+            key TEXT PRIMARY KEY,
+            answer TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    '''
+    SQL_CREATE_ANSWER_CACHE_INDEX = "CREATE INDEX IF NOT EXISTS idx_answer_cache_created ON answer_cache (created_at)"
+    SQL_GET_ANSWER = "SELECT answer, created_at FROM answer_cache WHERE key = ?"
+    SQL_PUT_ANSWER = "INSERT OR REPLACE INTO answer_cache (key, answer, created_at) VALUES (?, ?, ?)"
+    SQL_EXPIRE_ANSWERS = "DELETE FROM answer_cache WHERE created_at < ?"
+    SQL_TRIM_ANSWERS = '''
+        DELETE FROM answer_cache WHERE key IN (
+            SELECT key FROM answer_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?
+        )
+    '''
+    SQL_PURGE_ANSWERS = "DELETE FROM answer_cache"
+    SQL_CREATE_FSM = '''
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at REAL NOT NULL
+        )
+    '''
+    SQL_CREATE_FSM_INDEX = "CREATE INDEX IF NOT EXISTS idx_fsm_state_updated_at ON fsm_state (updated_at)"
+    SQL_GET_FSM = "SELECT state, data, updated_at FROM fsm_state WHERE key = ?"
+    SQL_PUT_FSM = "INSERT OR REPLACE INTO fsm_state (key, state, data, updated_at) VALUES (?, ?, ?, ?)"
+    SQL_DELETE_FSM = "DELETE FROM fsm_state WHERE key = ?"
+    SQL_EXPIRE_FSM = "DELETE FROM fsm_state WHERE updated_at < ?"
+    # Агрегаты для /stats ведутся триггерами, чтобы не сканировать users
+    SQL_CREATE_STATS_COUNTERS = '''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    '''
+    SQL_CREATE_STATS_DAILY = '''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT NOT NULL,
+            name TEXT NOT NULL,
+            value INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, name)
+        )
+    '''
+    SQL_CREATE_STATS_TRIGGERS = (
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_insert_stats AFTER INSERT ON users BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('users_total', 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO stats_counters (name, value) VALUES ('users_subscribed', COALESCE(NEW.subscribed, 0) != 0)
+                ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO stats_daily (day, name, value) VALUES (date(NEW.created_at), 'new_users', 1)
+                ON CONFLICT(day, name) DO UPDATE SET value = value + excluded.value;
+            INSERT INTO stats_daily (day, name, value) SELECT date('now'), 'questions', NEW.questions_count
+                WHERE NEW.questions_count > 0
+                ON CONFLICT(day, name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_subscribed_stats AFTER UPDATE OF subscribed ON users
+        WHEN (COALESCE(OLD.subscribed, 0) != 0) != (COALESCE(NEW.subscribed, 0) != 0) BEGIN
+            UPDATE stats_counters
+            SET value = value + (COALESCE(NEW.subscribed, 0) != 0) - (COALESCE(OLD.subscribed, 0) != 0)
+            WHERE name = 'users_subscribed';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS trg_users_questions_stats AFTER UPDATE OF questions_count ON users
+        WHEN NEW.questions_count != OLD.questions_count BEGIN
+            INSERT INTO stats_daily (day, name, value) VALUES (date('now'), 'questions', NEW.questions_count - OLD.questions_count)
+                ON CONFLICT(day, name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+    )
+    # Триггеры "на лимите" зависят от QUOTA_LIMITS и пересоздаются при каждом запуске
+    SQL_DROP_QUOTA_TRIGGERS = (
+        "DROP TRIGGER IF EXISTS trg_users_quota_insert",
+        "DROP TRIGGER IF EXISTS trg_users_quota_update",
+    )
+    SQL_CREATE_QUOTA_TRIGGERS = (
+        '''
+        CREATE TRIGGER trg_users_quota_insert AFTER INSERT ON users WHEN NEW.questions_count >= {limit} BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('users_at_quota', 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+        '''
+        CREATE TRIGGER trg_users_quota_update AFTER UPDATE OF questions_count ON users
+        WHEN (OLD.questions_count >= {limit}) != (NEW.questions_count >= {limit}) BEGIN
+            INSERT INTO stats_counters (name, value) VALUES ('users_at_quota', (NEW.questions_count >= {limit}) - (OLD.questions_count >= {limit}))
+                ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        END
+        ''',
+    )
+    # Полный пересчет — только при первом запуске со счетчиками или смене лимита
+    SQL_BACKFILL_STATS = (
+        "DELETE FROM stats_counters WHERE name IN ('users_total', 'users_subscribed')",
+        "INSERT INTO stats_counters (name, value) SELECT 'users_total', COUNT(*) FROM users",
+        "INSERT INTO stats_counters (name, value) SELECT 'users_subscribed', COUNT(*) FROM users WHERE COALESCE(subscribed, 0) != 0",
+        "DELETE FROM stats_daily WHERE name = 'new_users'",
+        '''
+        INSERT INTO stats_daily (day, name, value)
+        SELECT date(created_at), 'new_users', COUNT(*) FROM users GROUP BY date(created_at)
+        ''',
+    )
+    SQL_BACKFILL_QUOTA = "INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'users_at_quota', COUNT(*) FROM users WHERE questions_count >= ?"
+    SQL_CREATE_BROADCASTS = '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_chat_id INTEGER NOT NULL,
+            text TEXT,
+            from_chat_id INTEGER,
+            message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            owner TEXT,
+            lease_until REAL NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    '''
+    SQL_CREATE_BROADCAST = '''
+        INSERT INTO broadcasts (admin_chat_id, text, from_chat_id, message_id, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        RETURNING id
+    '''
+    SQL_GET_BROADCAST = "SELECT * FROM broadcasts WHERE id = ?"
+    SQL_ACTIVE_BROADCASTS = "SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id"
+    # Аренда: задачу выполняет только один процесс, после рестарта ее подхватывают по истечении аренды
+    # Одновременно идет только одна рассылка: задачу нельзя захватить, пока другая держит живую аренду
+    SQL_CLAIM_BROADCAST = '''
+        UPDATE broadcasts SET owner = ?, lease_until = ?
+        WHERE id = ? AND status = 'running' AND (owner = ? OR lease_until < ?)
+            AND NOT EXISTS (
+                SELECT 1 FROM broadcasts AS other
+                WHERE other.id != broadcasts.id AND other.status = 'running' AND other.lease_until >= ?
+            )
+        RETURNING id
+    '''
+    SQL_CHECKPOINT_BROADCAST = '''
+        UPDATE broadcasts
+        SET last_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?,
+            lease_until = ?, updated_at = ?
+        WHERE id = ? AND owner = ?
+    '''
+    SQL_RENEW_BROADCAST_LEASE = '''
+        UPDATE broadcasts SET lease_until = ?
+        WHERE id = ? AND owner = ? AND status = 'running'
+        RETURNING id
+    '''
+    SQL_SET_BROADCAST_STATUS = "UPDATE broadcasts SET status = ?, updated_at = ? WHERE id = ? AND status = 'running'"
+    # Keyset-пагинация получателей по первичному ключу
+    SQL_BROADCAST_RECIPIENTS = '''
+        SELECT user_id FROM users
+        WHERE user_id > ? AND NOT COALESCE(blocked, FALSE)
+        ORDER BY user_id LIMIT ?
+    '''
+    SQL_MARK_BLOCKED = "UPDATE users SET blocked = TRUE WHERE user_id = ?"
+    SQL_SET_COUNTER = "INSERT OR REPLACE INTO stats_counters (name, value) VALUES (?, ?)"
+    SQL_GET_COUNTERS = "SELECT name, value FROM stats_counters"
+    SQL_GET_DAILY = "SELECT day, name, value FROM stats_daily WHERE day >= date('now', ?) ORDER BY day"
+
+    def __init__(self, db_path: str = None, write_behind: bool = None):
+        self.db_path = _sqlite_path(db_path or DATABASE_URL)
+        self._conn = None
+        # Одно долгоживущее соединение: все запросы идут через его поток,
+        # блокировка не дает одиночным запросам попасть внутрь чужой транзакции
+        self._lock = asyncio.Lock()
+        # Очередь отложенной записи
+        self.write_behind = DB_WRITE_BEHIND if write_behind is None else write_behind
+        self._pending_users = set()
+        self._pending_increments = {}
+        # Пачка, которая сейчас пишется на диск (нужна, чтобы чтения ее не "теряли")
+        self._inflight_increments = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_wakeup = asyncio.Event()
+        self._flush_task = None
+        self._flush_stopping = False
 
     async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    subscribed BOOLEAN DEFAULT FALSE,
-                    questions_count INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            await db.commit()
+        if self._conn is None:
+            # isolation_level=None — автокоммит: одиночный запрос сразу фиксируется без отдельного commit()
+            self._conn = await aiosqlite.connect(
+                self.db_path,
+                isolation_level=None,
+                cached_statements=DB_STATEMENT_CACHE
+            )
+            for pragma in DB_PRAGMAS:
+                await self._conn.execute(pragma)
+        await self._conn.execute(self.SQL_CREATE_USERS)
+        columns = {row[0] for row in await self._conn.execute_fetchall(self.SQL_USERS_COLUMNS)}
+        if "blocked" not in columns:
+            await self._conn.execute(self.SQL_ADD_BLOCKED_COLUMN)
+        await self._conn.execute(self.SQL_CREATE_BROADCASTS)
+        await self._conn.execute(self.SQL_CREATE_ANSWER_CACHE)
+        await self._conn.execute(self.SQL_CREATE_ANSWER_CACHE_INDEX)
+        await self._conn.execute(self.SQL_CREATE_FSM)
+        await self._conn.execute(self.SQL_CREATE_FSM_INDEX)
+        await self._init_stats()
+        if self.write_behind and self._flush_task is None:
+            self._flush_stopping = False
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _init_stats(self):
+        conn = self._connection()
+        limit = QUOTA_LIMITS["user"]
+        async with self._lock:
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                await conn.execute(self.SQL_CREATE_STATS_COUNTERS)
+                await conn.execute(self.SQL_CREATE_STATS_DAILY)
+                for sql in self.SQL_CREATE_STATS_TRIGGERS + self.SQL_DROP_QUOTA_TRIGGERS:
+                    await conn.execute(sql)
+                if limit >= 0:
+                    for sql in self.SQL_CREATE_QUOTA_TRIGGERS:
+                        await conn.execute(sql.format(limit=int(limit)))
+                counters = dict(await conn.execute_fetchall(self.SQL_GET_COUNTERS))
+                if "users_total" not in counters:
+                    for sql in self.SQL_BACKFILL_STATS:
+                        await conn.execute(sql)
+                if counters.get("quota_limit") != limit:
+                    if limit >= 0:
+                        await conn.execute(self.SQL_BACKFILL_QUOTA, (limit,))
+                    else:
+                        await conn.execute(self.SQL_SET_COUNTER, ("users_at_quota", 0))
+                    await conn.execute(self.SQL_SET_COUNTER, ("quota_limit", limit))
+                await conn.execute("COMMIT")
+            except Exception:
+                await conn.execute("ROLLBACK")
+                raise
+
+    async def close(self):
+        # Сначала дренируем очередь отложенной записи, чтобы ничего не потерять.
+        # Цикл не отменяем: отмена посреди flush() обрывает транзакцию с уже забранной пачкой
+        if self._flush_task is not None:
+            self._flush_stopping = True
+            self._flush_wakeup.set()
+            await self._flush_task
+            self._flush_task = None
+        if self._conn is not None:
+            await self.flush()
+            async with self._lock:
+                await self._conn.close()
+                self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            raise RuntimeError("База данных не инициализирована: вызовите init_db()")
+        return self._conn
+
+    async def _execute(self, sql: str, params: tuple = ()):
+        conn = self._connection()
+        async with self._lock:
+            await conn.execute(sql, params)
+
+    async def _executemany_tx(self, batches) -> list:
+        # batches: последовательность (sql, список параметров); все пишется одной транзакцией.
+        # Возвращает число измененных строк по каждой пачке
+        conn = self._connection()
+        rowcounts = []
+        async with self._lock:
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, rows in batches:
+                    if rows:
+                        cursor = await conn.executemany(sql, rows)
+                        rowcounts.append(cursor.rowcount)
+                    else:
+                        rowcounts.append(0)
+                await conn.execute("COMMIT")
+            except BaseException:
+                # В том числе при отмене задачи: иначе транзакция останется открытой на соединении
+                await conn.execute("ROLLBACK")
+                raise
+        return rowcounts
+
+    async def _fetchone(self, sql: str, params: tuple = ()):
+        conn = self._connection()
+        async with self._lock:
+            rows = await conn.execute_fetchall(sql, params)
+        return rows[0] if rows else None
+
+    # Отложенная запись
+    def _pending_size(self):
+        return len(self._pending_users) + len(self._pending_increments)
+
+    def _notify_flusher(self):
+        if self._pending_size() >= DB_FLUSH_SIZE:
+            self._flush_wakeup.set()
+
+    async def _flush_loop(self):
+        while not self._flush_stopping:
+            try:
+                await asyncio.wait_for(self._flush_wakeup.wait(), timeout=DB_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка отложенной записи в БД: {str(e)}")
 
+    @timed("bot_db_query_seconds", "method")
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending_size():
+                return
+            users, self._pending_users = self._pending_users, set()
+            increments, self._pending_increments = self._pending_increments, {}
+            self._inflight_increments = increments
+            try:
+                await self._executemany_tx((
+                    (self.SQL_ADD_USER, [(user_id,) for user_id in users]),
+                    (self.SQL_ADD_QUESTIONS, [(delta, user_id) for user_id, delta in increments.items()]),
+                ))
+            except BaseException:
+                # Возвращаем пачку в очередь (в том числе при отмене), чтобы повторить при следующем сбросе
+                self._pending_users |= users
+                for user_id, delta in increments.items():
+                    self._pending_increments[user_id] = self._pending_increments.get(user_id, 0) + delta
+                raise
+            finally:
+                self._inflight_increments = {}
+
+    @timed("bot_db_query_seconds", "method")
     async def add_user(self, user_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                "INSERT OR IGNORE INTO users (user_id) VALUES (?)",
-                (user_id,)
-            )
-            await db.commit()
+        if self.write_behind:
+            self._pending_users.add(user_id)
+            self._notify_flusher()
+            return
+        await self._execute(self.SQL_ADD_USER, (user_id,))
 
+    @timed("bot_db_query_seconds", "method")
     async def update_subscription(self, user_id: int, status: bool):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                "UPDATE users SET subscribed = ? WHERE user_id = ?",
-                (status, user_id)
-            )
-            await db.commit()
+        if user_id in self._pending_users:
+            await self.flush()
+        await self._execute(self.SQL_UPDATE_SUBSCRIPTION, (user_id, status))
+
+    @timed("bot_db_query_seconds", "method")
+    async def get_subscription(self, user_id: int):
+        result = await self._fetchone(self.SQL_GET_SUBSCRIPTION, (user_id,))
+        return bool(result[0]) if result else None
 
+    @timed("bot_db_query_seconds", "method")
     async def increment_question_count(self, user_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                "UPDATE users SET questions_count = questions_count + 1 WHERE user_id = ?",
-                (user_id,)
-            )
-            await db.commit()
+        if self.write_behind:
+            self._pending_increments[user_id] = self._pending_increments.get(user_id, 0) + 1
+            self._notify_flusher()
+            return
+        await self._execute(self.SQL_INCREMENT_QUESTIONS, (user_id,))
 
+    @timed("bot_db_query_seconds", "method")
     async def get_question_count(self, user_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute("SELECT questions_count FROM users WHERE user_id = ?", (user_id,))
-            result = await cursor.fetchone()
-            return result[0] if result else 0
+        result = await self._fetchone(self.SQL_GET_QUESTIONS, (user_id,))
+        count = result[0] if result else 0
+        # Учитываем еще не записанные на диск инкременты
+        return count + self._pending_increments.get(user_id, 0) + self._inflight_increments.get(user_id, 0)
+
+    @timed("bot_db_query_seconds", "method")
+    async def consume_question(self, user_id: int, limit: int):
+        # Возвращает новое значение счетчика или None, если лимит исчерпан
+        if self._pending_increments.get(user_id):
+            await self.flush()
+        result = await self._fetchone(self.SQL_CONSUME_QUESTION, (user_id, limit))
+        return result[0] if result else None
+
+    @timed("bot_db_query_seconds", "method")
+    async def refund_question(self, user_id: int):
+        if self._pending_increments.get(user_id):
+            await self.flush()
+        result = await self._fetchone(self.SQL_REFUND_QUESTION, (user_id,))
+        return result[0] if result else None
+
+    @timed("bot_db_query_seconds", "method")
+    async def get_cached_answer(self, key: str):
+        return await self._fetchone(self.SQL_GET_ANSWER, (key,))
 
+    @timed("bot_db_query_seconds", "method")
+    async def put_cached_answer(self, key: str, answer: str):
+        await self._execute(self.SQL_PUT_ANSWER, (key, answer, time.time()))
+
+    @timed("bot_db_query_seconds", "method")
+    async def expire_cached_answers(self, max_age: float, max_rows: int = None):
+        await self._execute(self.SQL_EXPIRE_ANSWERS, (time.time() - max_age,))
+        if max_rows is not None and max_rows >= 0:
+            # Сверх лимита удаляются самые старые ответы
+            await self._execute(self.SQL_TRIM_ANSWERS, (max_rows,))
+
+    @timed("bot_db_query_seconds", "method")
+    async def purge_cached_answers(self):
+        await self._execute(self.SQL_PURGE_ANSWERS)
+
+    @timed("bot_db_query_seconds", "method")
+    async def get_fsm(self, key: str):
+        return await self._fetchone(self.SQL_GET_FSM, (key,))
+
+    @timed("bot_db_query_seconds", "method")
+    async def save_fsm(self, upserts: list, deletes: list):
+        # upserts: (key, state, data_json, updated_at); deletes: (key,)
+        await self._executemany_tx((
+            (self.SQL_PUT_FSM, upserts),
+            (self.SQL_DELETE_FSM, deletes),
+        ))
+
+    @timed("bot_db_query_seconds", "method")
+    async def expire_fsm(self, max_age: float):
+        await self._execute(self.SQL_EXPIRE_FSM, (time.time() - max_age,))
+
+    # Рассылки
+    @timed("bot_db_query_seconds", "method")
+    async def create_broadcast(self, admin_chat_id: int, text: str = None, from_chat_id: int = None, message_id: int = None) -> int:
+        now = time.time()
+        row = await self._fetchone(self.SQL_CREATE_BROADCAST, (admin_chat_id, text, from_chat_id, message_id, now, now))
+        return row[0]
+
+    @timed("bot_db_query_seconds", "method")
+    async def get_broadcast(self, broadcast_id: int):
+        conn = self._connection()
+        async with self._lock:
+            async with conn.execute(self.SQL_GET_BROADCAST, (broadcast_id,)) as cursor:
+                row = await cursor.fetchone()
+                if row is None:
+                    return None
+                return dict(zip([column[0] for column in cursor.description], row))
+
+    @timed("bot_db_query_seconds", "method")
+    async def get_active_broadcasts(self) -> list:
+        conn = self._connection()
+        async with self._lock:
+            rows = await conn.execute_fetchall(self.SQL_ACTIVE_BROADCASTS)
+        return [row[0] for row in rows]
+
+    @timed("bot_db_query_seconds", "method")
+    async def claim_broadcast(self, broadcast_id: int, owner: str, lease: float) -> bool:
+        now = time.time()
+        return await self._fetchone(self.SQL_CLAIM_BROADCAST, (owner, now + lease, broadcast_id, owner, now, now)) is not None
+
+    @timed("bot_db_query_seconds", "method")
+    async def renew_broadcast_lease(self, broadcast_id: int, owner: str, lease: float) -> bool:
+        # В отличие от claim_broadcast не перехватывает истекшую аренду: только продлевает свою
+        return await self._fetchone(self.SQL_RENEW_BROADCAST_LEASE, (time.time() + lease, broadcast_id, owner)) is not None
+
+    @timed("bot_db_query_seconds", "method")
+    async def checkpoint_broadcast(self, broadcast_id: int, owner: str, last_user_id: int,
+                                   sent: int, failed: int, blocked_users: list, lease: float) -> bool:
+        # Отметки о блокировке и прогресс пишутся одной транзакцией.
+        # False — аренду уже забрал другой процесс, и прогресс не записан
+        now = time.time()
+        rowcounts = await self._executemany_tx((
+            (self.SQL_MARK_BLOCKED, [(user_id,) for user_id in blocked_users]),
+            (self.SQL_CHECKPOINT_BROADCAST, [(
+                last_user_id, sent, failed, len(blocked_users), now + lease, now, broadcast_id, owner
+            )]),
+        ))
+        return rowcounts[1] > 0
+
+    @timed("bot_db_query_seconds", "method")
+    async def set_broadcast_status(self, broadcast_id: int, status: str):
+        await self._execute(self.SQL_SET_BROADCAST_STATUS, (status, time.time(), broadcast_id))
+
+    @timed("bot_db_query_seconds", "method")
+    async def get_broadcast_recipients(self, after_user_id: int, limit: int) -> list:
+        conn = self._connection()
+        async with self._lock:
+            rows = await conn.execute_fetchall(self.SQL_BROADCAST_RECIPIENTS, (after_user_id, limit))
+        return [row[0] for row in rows]
+
+    @timed("bot_db_query_seconds", "method")
     async def get_stats(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute("SELECT COUNT(*) FROM users")
-            total_users = await cursor.fetchone()
-            cursor = await db.execute("SELECT COUNT(*) FROM users WHERE subscribed = TRUE")
-            active_users = await cursor.fetchone()
-            return total_users[0], active_users[0]
+        # Возвращает счетчики: users_total, users_subscribed, users_at_quota
+        await self.flush()
+        conn = self._connection()
+        async with self._lock:
+            counters = dict(await conn.execute_fetchall(self.SQL_GET_COUNTERS))
+        return {
+            "users_total": counters.get("users_total", 0),
+            "users_subscribed": counters.get("users_subscribed", 0),
+            "users_at_quota": counters.get("users_at_quota", 0),
+        }
+
+    @timed("bot_db_query_seconds", "method")
+    async def get_daily_stats(self, days: int = 7):
+        # {день: {"new_users": n, "questions": n}} за последние days дней
+        conn = self._connection()
+        async with self._lock:
+            rows = await conn.execute_fetchall(self.SQL_GET_DAILY, (f"-{days - 1} days",))
+        daily = {}
+        for day, name, value in rows:
+            daily.setdefault(day, {})[name] = value
+        return daily
 
 db = Database()
 
+# Хранилище FSM в SQLite с горячим LRU в памяти и пакетной записью
+class SQLiteStorage(BaseStorage):
+    def __init__(self, database: Database, ttl: float = None, cache_ttl: float = None):
+        self.db = database
+        # Неактивные состояния (например, Form.ask_neuro) истекают через ttl секунд
+        self.ttl = FSM_TTL if ttl is None else ttl
+        # 0 — без горячего слоя: чтение и запись сразу в БД (несколько процессов)
+        self.cache_ttl = FSM_CACHE_TTL if cache_ttl is None else cache_ttl
+        # key -> [state, data, touched_at, cached_at]; touched_at — time.time() последнего изменения
+        self._cache = OrderedDict()
+        self._dirty = set()
+        # Ключи, которые сейчас пишутся на диск: пока запись не завершена, БД для них устарела
+        self._flushing = set()
+        self._flush_wakeup = asyncio.Event()
+        self._flush_task = None
+        self._flush_stopping = False
+        self._last_expire = 0.0
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    def _expired(self, touched_at: float) -> bool:
+        return self.ttl > 0 and time.time() - touched_at > self.ttl
+
+    async def start(self):
+        if self.cache_ttl > 0 and self._flush_task is None:
+            self._flush_stopping = False
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while not self._flush_stopping:
+            try:
+                await asyncio.wait_for(self._flush_wakeup.wait(), timeout=FSM_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи FSM в БД: {str(e)}")
+
+    async def flush(self):
+        if self._dirty:
+            dirty, self._dirty = self._dirty, set()
+            self._flushing = dirty
+            upserts, deletes = [], []
+            for key in dirty:
+                record = self._cache.get(key)
+                if record is None:
+                    continue
+                state, data, touched_at, _ = record
+                if state is None and not data:
+                    deletes.append((key,))
+                else:
+                    upserts.append((key, state, json.dumps(data, ensure_ascii=False), touched_at))
+            try:
+                await self.db.save_fsm(upserts, deletes)
+            except BaseException:
+                # Возвращаем ключи (в том числе при отмене), чтобы записать их при следующем сбросе
+                self._dirty |= dirty
+                raise
+            finally:
+                self._flushing = set()
+        if self.ttl > 0 and time.monotonic() - self._last_expire > FSM_EXPIRE_INTERVAL:
+            self._last_expire = time.monotonic()
+            await self.db.expire_fsm(self.ttl)
+
+    async def _load(self, key: str) -> list:
+        record = self._cache.get(key)
+        pinned = key in self._dirty or key in self._flushing
+        if record is not None and (pinned or time.monotonic() - record[3] < self.cache_ttl):
+            self._cache.move_to_end(key)
+        else:
+            row = await self.db.get_fsm(key)
+            if row is None:
+                record = [None, {}, time.time(), time.monotonic()]
+            else:
+                record = [row[0], json.loads(row[1]), row[2], time.monotonic()]
+            if self.cache_ttl > 0:
+                self._remember(key, record)
+        if self._expired(record[2]) and (record[0] is not None or record[1]):
+            record[0], record[1] = None, {}
+            await self._save(key, record)
+        return record
+
+    def _remember(self, key: str, record: list):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        # Вытесняем только записанные на диск контексты
+        while len(self._cache) > FSM_CACHE_SIZE:
+            oldest = next(iter(self._cache))
+            if oldest in self._dirty or oldest in self._flushing:
+                break
+            del self._cache[oldest]
+
+    async def _save(self, key: str, record: list):
+        record[2] = time.time()
+        if self.cache_ttl > 0:
+            self._remember(key, record)
+            self._dirty.add(key)
+            return
+        state, data = record[0], record[1]
+        if state is None and not data:
+            await self.db.save_fsm([], [(key,)])
+        else:
+            await self.db.save_fsm([(key, state, json.dumps(data, ensure_ascii=False), record[2])], [])
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        skey = self._key(key)
+        record = await self._load(skey)
+        record[0] = state.state if isinstance(state, State) else state
+        await self._save(skey, record)
+
+    async def get_state(self, key: StorageKey):
+        return (await self._load(self._key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        skey = self._key(key)
+        record = await self._load(skey)
+        record[1] = data.copy()
+        await self._save(skey, record)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return (await self._load(self._key(key)))[1].copy()
+
+    async def close(self) -> None:
+        # Цикл не отменяем, а дожидаемся: отмена посреди save_fsm теряет забранные ключи
+        if self._flush_task is not None:
+            self._flush_stopping = True
+            self._flush_wakeup.set()
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
+
+storage = SQLiteStorage(db)
+dp = Dispatcher(storage=storage)
+router = Router()
+dp.include_router(router)
+# Корреляция записей лога с апдейтом (контекст наследуется всеми задачами обработки)
+class CorrelationMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        token = update_id_var.set(event.update_id)
+        try:
+            return await handler(event, data)
+        finally:
+            update_id_var.reset(token)
+
+dp.update.outer_middleware(CorrelationMiddleware())
+router.message.middleware(HandlerMetricsMiddleware())
+router.callback_query.middleware(HandlerMetricsMiddleware())
+
+# Квоты вопросов к нейросети
+class QuotaManager:
+    def __init__(self, database: Database, limits: dict = None):
+        self.db = database
+        self.limits = limits or QUOTA_LIMITS
+        # user_id -> (questions_count, expires_at); обновляется при каждой записи
+        self._cache = OrderedDict()
+
+    def role_of(self, user_id: int) -> str:
+        return "admin" if user_id in ADMIN_IDS else "user"
+
+    def limit_for(self, user_id: int):
+        limit = self.limits.get(self.role_of(user_id), -1)
+        return None if limit < 0 else limit
+
+    def _cached_count(self, user_id: int):
+        entry = self._cache.get(user_id)
+        if entry is None:
+            return None
+        count, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._cache[user_id]
+            return None
+        self._cache.move_to_end(user_id)
+        return count
+
+    def _remember(self, user_id: int, count: int):
+        self._cache[user_id] = (count, time.monotonic() + QUOTA_CACHE_TTL)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > QUOTA_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    def invalidate(self, user_id: int = None):
+        if user_id is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(user_id, None)
+
+    async def try_consume(self, user_id: int) -> bool:
+        limit = self.limit_for(user_id)
+        if limit is None:
+            return True
+        # Исчерпанный лимит отсекаем без обращения к БД
+        count = self._cached_count(user_id)
+        if limit <= 0 or (count is not None and count >= limit):
+            return False
+        # Списание идет мимо отложенной записи (DB_WRITE_BEHIND) намеренно: проверка лимита
+        # и инкремент должны быть одним атомарным UPDATE, иначе параллельные вопросы превысят лимит
+        count = await self.db.consume_question(user_id, limit)
+        if count is None:
+            self._remember(user_id, limit)
+            return False
+        self._remember(user_id, count)
+        return True
+
+    async def refund(self, user_id: int):
+        # Возврат вопроса, если нейросеть не ответила
+        if self.limit_for(user_id) is None:
+            return
+        count = await self.db.refund_question(user_id)
+        if count is None:
+            self.invalidate(user_id)
+        else:
+            self._remember(user_id, count)
+
+quota = QuotaManager(db)
+
+# Кэш проверки подписки на канал
+class SubscriptionCache:
+    MEMBER_STATUSES = ("member", "administrator", "creator")
+
+    def __init__(self, database: Database, channel_id: str = None):
+        self.db = database
+        self.channel_id = channel_id or CHANNEL_ID
+        # user_id -> (subscribed, expires_at); просроченные записи остаются как последний известный статус
+        self._entries = OrderedDict()
+        # Параллельные проверки одного пользователя ждут один запрос к Telegram
+        self._inflight = {}
+        self.stats = {"hits": 0, "api_calls": 0, "api_errors": 0}
+
+    def _remember(self, user_id: int, status: bool, ttl: float):
+        self._entries[user_id] = (status, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > SUBSCRIPTION_CACHE_SIZE:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+    async def is_subscribed(self, user_id: int) -> bool:
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[1] >= time.monotonic():
+            self.stats["hits"] += 1
+            return entry[0]
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._refresh(user_id))
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def _refresh(self, user_id: int) -> bool:
+        entry = self._entries.get(user_id)
+        known = entry[0] if entry is not None else None
+        try:
+            self.stats["api_calls"] += 1
+            member = await bot.get_chat_member(self.channel_id, user_id)
+        except Exception as e:
+            # Telegram недоступен — используем последний известный статус
+            self.stats["api_errors"] += 1
+            logger.error(f"Ошибка проверки подписки {user_id}: {str(e)}")
+            if known is None:
+                try:
+                    known = await self.db.get_subscription(user_id)
+                except Exception as db_error:
+                    logger.error(f"Ошибка чтения подписки из БД: {str(db_error)}")
+            status = bool(known)
+            self._remember(user_id, status, SUBSCRIPTION_NEGATIVE_TTL)
+            return status
+        status = member.status in self.MEMBER_STATUSES
+        self._remember(user_id, status, SUBSCRIPTION_TTL if status else SUBSCRIPTION_NEGATIVE_TTL)
+        if status != known:
+            try:
+                await self.db.update_subscription(user_id, status)
+            except Exception as e:
+                logger.error(f"Ошибка записи подписки в БД: {str(e)}")
+        return status
+
+subscriptions = SubscriptionCache(db)
+
+# История диалога хранится в данных FSM: общая для воркеров, вытесняется вместе с сессией (FSM_TTL)
+# и занимает не больше бюджета своей роли. Формат компактный:
+# {"turns": [[вопрос, ответ], ...], "summary": str, "at": unix-время последней реплики}
+class ConversationHistory:
+    def __init__(self, budgets: dict = None, ttl: float = None, summarize: bool = None):
+        self.budgets = budgets or HISTORY_BUDGETS
+        self.ttl = ttl or HISTORY_TTL
+        self.summarize = HISTORY_SUMMARY if summarize is None else summarize
+
+    @staticmethod
+    def tokens(text: str) -> int:
+        # Оценка без токенизатора; для русского текста ~3 символа на токен
+        return int(len(text) / HISTORY_CHARS_PER_TOKEN) + 1
+
+    @staticmethod
+    def _clip(text: str, tokens: int) -> str:
+        limit = max(int(tokens * HISTORY_CHARS_PER_TOKEN), 1)
+        return text if len(text) <= limit else text[:limit - 1] + "…"
+
+    def _fresh(self, history) -> dict:
+        if not history or time.time() - history.get("at", 0) > self.ttl:
+            return {"turns": [], "summary": ""}
+        return history
+
+    async def messages(self, state: FSMContext) -> list:
+        # Предыдущие реплики в формате chat/completions (без текущего вопроса)
+        if not HISTORY_ENABLED:
+            return []
+        history = self._fresh((await state.get_data()).get("history"))
+        messages = []
+        if history["summary"]:
+            messages.append({"role": "system", "content": f"Ранее в диалоге пользователь спрашивал: {history['summary']}"})
+        for question, answer in history["turns"]:
+            messages.append({"role": "user", "content": question})
+            messages.append({"role": "assistant", "content": answer})
+        return messages
+
+    async def append(self, state: FSMContext, role: str, question: str, answer: str):
+        if not HISTORY_ENABLED or not answer:
+            return
+        history = self._fresh((await state.get_data()).get("history"))
+        budget = self.budgets[role]
+        # Одна реплика не может занять весь бюджет, иначе контекст всегда был бы пустым
+        turns = history["turns"] + [[self._clip(question, budget // 4), self._clip(answer, budget // 2)]]
+        summary = history["summary"]
+        used = sum(self.tokens(q) + self.tokens(a) for q, a in turns) + (self.tokens(summary) if summary else 0)
+        while turns and used > budget:
+            old_question, old_answer = turns.pop(0)
+            used -= self.tokens(old_question) + self.tokens(old_answer)
+            if self.summarize:
+                if summary:
+                    used -= self.tokens(summary)
+                point = " ".join(old_question.split())
+                # Сжатый контекст — не больше четверти бюджета, старые пункты отбрасываются первыми
+                summary = self._clip(f"{point}; {summary}" if summary else point, budget // 4)
+                used += self.tokens(summary)
+        await state.update_data(history={"turns": turns, "summary": summary, "at": int(time.time())})
+
+    async def reset(self, state: FSMContext):
+        await state.update_data(history=None)
+
+conversations = ConversationHistory()
+
+# Token bucket: rate токенов в секунду, не больше capacity подряд
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1.0):
+        while not self.try_acquire(tokens):
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        # После RetryAfter от Telegram бакет "уходит в минус" на время паузы
+        self._refill()
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+# Рассылка по всем пользователям с чекпоинтами и возобновлением после рестарта
+class BroadcastManager:
+    def __init__(self, database: Database):
+        self.db = database
+        self.owner = f"{os.getpid()}-{random.getrandbits(32):08x}"
+        self.bucket = TokenBucket(BROADCAST_RATE)
+        self._tasks = {}
+        # broadcast_id -> оперативный прогресс для /broadcast_status
+        self.progress = {}
+
+    def start(self, broadcast_id: int):
+        if broadcast_id not in self._tasks:
+            task = asyncio.create_task(self._run(broadcast_id))
+            self._tasks[broadcast_id] = task
+            task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def create(self, admin_chat_id: int, text: str = None, from_chat_id: int = None, message_id: int = None) -> int:
+        broadcast_id = await self.db.create_broadcast(admin_chat_id, text, from_chat_id, message_id)
+        self.start(broadcast_id)
+        return broadcast_id
+
+    async def resume(self):
+        for broadcast_id in await self.db.get_active_broadcasts():
+            self.start(broadcast_id)
+
+    async def cancel(self, broadcast_id: int):
+        await self.db.set_broadcast_status(broadcast_id, "cancelled")
+        task = self._tasks.get(broadcast_id)
+        if task is not None:
+            task.cancel()
+
+    async def stop(self):
+        # Задачи остаются в статусе running и продолжатся после перезапуска с последнего чекпоинта
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _send(self, job: dict, user_id: int, lease_lost: asyncio.Event) -> str:
+        while True:
+            await self.bucket.acquire()
+            # Проверяем перед каждой попыткой: пауза RetryAfter может пережить аренду
+            if lease_lost.is_set():
+                return "skipped"
+            try:
+                if job["from_chat_id"] is not None:
+                    await bot.copy_message(user_id, job["from_chat_id"], job["message_id"])
+                else:
+                    await bot.send_message(user_id, job["text"])
+                return "sent"
+            except TelegramRetryAfter as e:
+                self.bucket.pause(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"
+            except TelegramAPIError as e:
+                logger.error(f"Рассылка: ошибка отправки {user_id}: {str(e)}")
+                return "failed"
+
+    async def _report(self, job: dict, progress: dict, final: bool = False):
+        elapsed = max(time.monotonic() - progress["started"], 1e-6)
+        rate = progress["session_sent"] / elapsed
+        text = (
+            f"📣 Рассылка #{job['id']}{' завершена' if final else ''}\n"
+            f"Отправлено: {progress['sent']}, ошибок: {progress['failed']}, заблокировали: {progress['blocked']}\n"
+            f"Скорость: {rate:.1f} сообщ./с"
+        )
+        try:
+            if progress.get("report_message") is None:
+                progress["report_message"] = await bot.send_message(job["admin_chat_id"], text)
+            else:
+                await progress["report_message"].edit_text(text)
+        except TelegramAPIError as e:
+            logger.error(f"Рассылка: не удалось отправить отчет: {str(e)}")
+
+    async def _run(self, broadcast_id: int):
+        # Пока аренда у другого процесса (или у прошлого запуска) либо идет другая рассылка, ждем
+        waiting = False
+        while not await self.db.claim_broadcast(broadcast_id, self.owner, BROADCAST_LEASE):
+            job = await self.db.get_broadcast(broadcast_id)
+            if job is None or job["status"] != "running":
+                return
+            if not waiting:
+                logger.info(f"Рассылка {broadcast_id}: ожидает завершения другой рассылки или истечения аренды")
+                waiting = True
+            await asyncio.sleep(max(job["lease_until"] - time.time(), 1.0))
+        job = await self.db.get_broadcast(broadcast_id)
+        progress = self.progress[broadcast_id] = {
+            "sent": job["sent"],
+            "failed": job["failed"],
+            "blocked": job["blocked"],
+            "session_sent": 0,
+            "started": time.monotonic(),
+            "report_message": None,
+        }
+        logger.info(f"Рассылка #{broadcast_id}: старт с user_id > {job['last_user_id']}")
+        last_user_id = job["last_user_id"]
+        last_report = 0.0
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        lease_lost = asyncio.Event()
+
+        async def send_one(user_id: int):
+            async with semaphore:
+                return await self._send(job, user_id, lease_lost)
+
+        async def keep_lease():
+            # Продлеваем аренду и внутри пачки: паузы RetryAfter не ограничены сверху
+            while True:
+                await asyncio.sleep(BROADCAST_LEASE / 3)
+                if not await self.db.renew_broadcast_lease(broadcast_id, self.owner, BROADCAST_LEASE):
+                    lease_lost.set()
+                    return
+
+        lease_task = asyncio.create_task(keep_lease())
+        try:
+            while True:
+                current = await self.db.get_broadcast(broadcast_id)
+                if current is None or current["status"] != "running":
+                    return
+                recipients = await self.db.get_broadcast_recipients(last_user_id, BROADCAST_BATCH)
+                if not recipients:
+                    break
+                results = await asyncio.gather(*(send_one(user_id) for user_id in recipients))
+                if lease_lost.is_set():
+                    logger.warning(f"Рассылка #{broadcast_id}: аренда перешла другому процессу, останавливаемся")
+                    return
+                blocked_users = [user_id for user_id, result in zip(recipients, results) if result == "blocked"]
+                sent = results.count("sent")
+                failed = results.count("failed")
+                last_user_id = recipients[-1]
+                if not await self.db.checkpoint_broadcast(
+                    broadcast_id, self.owner, last_user_id, sent, failed, blocked_users, BROADCAST_LEASE
+                ):
+                    logger.warning(f"Рассылка #{broadcast_id}: аренда перешла другому процессу, останавливаемся")
+                    return
+                progress["sent"] += sent
+                progress["failed"] += failed
+                progress["blocked"] += len(blocked_users)
+                progress["session_sent"] += sent
+                metrics.inc("bot_broadcast_messages_total", sent, result="sent")
+                metrics.inc("bot_broadcast_messages_total", failed, result="failed")
+                metrics.inc("bot_broadcast_messages_total", len(blocked_users), result="blocked")
+                if time.monotonic() - last_report >= BROADCAST_REPORT_INTERVAL:
+                    last_report = time.monotonic()
+                    await self._report(job, progress)
+            await self.db.set_broadcast_status(broadcast_id, "done")
+            await self._report(job, progress, final=True)
+            logger.info(f"Рассылка #{broadcast_id} завершена: {progress['sent']} отправлено")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Рассылка #{broadcast_id} прервана: {str(e)}")
+        finally:
+            lease_task.cancel()
+            self.progress.pop(broadcast_id, None)
+
+metrics.describe("bot_broadcast_messages_total", "counter", "Сообщения рассылки по результату")
+broadcasts = BroadcastManager(db)
+
+# Защита от флуда
+class _FloodRecord(TokenBucket):
+    __slots__ = ("last_notice",)
+
+    def __init__(self, rate: float, capacity: float):
+        super().__init__(rate, capacity)
+        self.last_notice = 0.0
+
+class FloodControl:
+    def __init__(self):
+        # user_id -> _FloodRecord; порядок — по последнему обращению, в начале самые давние
+        self._users = OrderedDict()
+        self.llm_active = 0
+
+    def _expire(self):
+        # Удаляем простаивающих пользователей с начала словаря: за FLOOD_IDLE_TTL бакет
+        # гарантированно восполнился, так что состояние можно забыть без потери точности
+        deadline = time.monotonic() - FLOOD_IDLE_TTL
+        while self._users:
+            user_id, record = next(iter(self._users.items()))
+            if record.updated_at >= deadline and len(self._users) <= FLOOD_MAX_USERS:
+                break
+            del self._users[user_id]
+
+    def check(self, user_id: int):
+        # Возвращает (разрешено, показать ли уведомление)
+        record = self._users.get(user_id)
+        if record is None:
+            self._expire()
+            record = self._users[user_id] = _FloodRecord(FLOOD_RATE, FLOOD_BURST)
+        else:
+            self._users.move_to_end(user_id)
+        if record.try_acquire():
+            return True, False
+        now = time.monotonic()
+        notify = now - record.last_notice >= FLOOD_NOTICE_INTERVAL
+        if notify:
+            record.last_notice = now
+        return False, notify
+
+    def try_acquire_llm(self) -> bool:
+        if self.llm_active >= FLOOD_LLM_CONCURRENCY:
+            return False
+        self.llm_active += 1
+        return True
+
+    def release_llm(self):
+        self.llm_active -= 1
+
+    @property
+    def tracked_users(self) -> int:
+        return len(self._users)
+
+class FloodControlMiddleware(BaseMiddleware):
+    # Внешний middleware роутера: срабатывает до фильтров и обработчиков, то есть до работы с БД и нейросетью
+    def __init__(self, flood: FloodControl):
+        self.flood = flood
+
+    async def __call__(self, handler, event, data):
+        user = getattr(event, "from_user", None)
+        if user is None or user.id in ADMIN_IDS:
+            return await handler(event, data)
+        allowed, notify = self.flood.check(user.id)
+        if allowed:
+            return await handler(event, data)
+        metrics.inc("bot_flood_rejected_total", kind=type(event).__name__)
+        if isinstance(event, types.CallbackQuery):
+            # На колбэк отвечаем всегда, иначе у пользователя "висят часики"
+            await event.answer(Texts.FLOOD if notify else None)
+        elif notify:
+            await event.answer(Texts.FLOOD)
+        return None
+
+metrics.describe("bot_flood_rejected_total", "counter", "Апдейты, отклоненные защитой от флуда")
+flood_control = FloodControl()
+router.message.outer_middleware(FloodControlMiddleware(flood_control))
+router.callback_query.outer_middleware(FloodControlMiddleware(flood_control))
+
 # Управление клавиатурами через JSON
+KEYBOARD_CACHE_SIZE = int(os.getenv("KEYBOARD_CACHE_SIZE", 1024))
+_formatter = string.Formatter()
+
+def _has_placeholders(value: str) -> bool:
+    return any(field is not None for _, field, _, _ in _formatter.parse(value))
+
 class KeyboardManager:
+    MAIN_MENU = "main_menu"
+    BACK_CALLBACK = "back"
+
     def __init__(self, config_path: str = "keyboards_config.json"):
         self.config_path = config_path
-        self.config = self._load_config()
+        self.config = None
+        # Готовые клавиатуры меню без подстановок: menu_name -> markup
+        self._static = {}
+        self._templates = {}
+        self._texts = {}
+        # Таблица переходов: callback_data -> имя меню
+        self._routes = {}
+        # LRU готовых клавиатур для меню с подстановками: (menu_name, kwargs) -> markup
+        self._param_cache = OrderedDict()
+        self.reload_config()
 
     def _load_config(self):
         try:
@@ -156,31 +1646,120 @@ class KeyboardManager:
         except (FileNotFoundError, json.JSONDecodeError) as e:
             raise RuntimeError(f"Ошибка загрузки конфигурации клавиатур: {str(e)}")
 
-    def get_markup(self, menu_name: str, **kwargs) -> InlineKeyboardMarkup:
-        menu_config = self.config.get(menu_name)
-        if not menu_config:
-            raise ValueError(f"Меню {menu_name} не найдено в конфигурации")
-        
-        buttons = []
+    @staticmethod
+    def _validate_menu(menu_name: str, menu_config) -> list:
+        if not isinstance(menu_config, dict) or not isinstance(menu_config.get("buttons"), list):
+            raise ValueError(f"Меню {menu_name}: ожидается объект со списком buttons")
+        rows = []
         for row in menu_config["buttons"]:
+            if not isinstance(row, list):
+                raise ValueError(f"Меню {menu_name}: строка кнопок должна быть списком")
+            for btn in row:
+                if not isinstance(btn, dict) or not isinstance(btn.get("text"), str):
+                    raise ValueError(f"Меню {menu_name}: у кнопки нет text")
+                if ("url" in btn) == ("callback_data" in btn):
+                    raise ValueError(f"Меню {menu_name}: у кнопки {btn['text']!r} должен быть ровно один из url/callback_data")
+                if "callback_data" in btn and len(str(btn["callback_data"]).encode("utf-8")) > 64:
+                    raise ValueError(f"Меню {menu_name}: callback_data длиннее 64 байт")
+                if "menu" in btn and "callback_data" not in btn:
+                    raise ValueError(f"Меню {menu_name}: переход menu у кнопки {btn['text']!r} требует callback_data")
+            rows.append(row)
+        return rows
+
+    @staticmethod
+    def _build(rows: list, **kwargs) -> InlineKeyboardMarkup:
+        buttons = []
+        for row in rows:
             keyboard_row = []
             for btn in row:
                 text = btn["text"].format(**kwargs)
                 if "url" in btn:
                     url = btn["url"].format(**kwargs)
                     keyboard_row.append(InlineKeyboardButton(text=text, url=url))
-                elif "callback_data" in btn:
-                    callback_data = btn["callback_data"]
-                    keyboard_row.append(InlineKeyboardButton(text=text, callback_data=callback_data))
+                else:
+                    keyboard_row.append(InlineKeyboardButton(text=text, callback_data=btn["callback_data"]))
             buttons.append(keyboard_row)
-        
         return InlineKeyboardMarkup(inline_keyboard=buttons)
 
+    def _compile(self, config: dict):
+        # Собираем все меню заранее; при любой ошибке текущие кэши остаются нетронутыми
+        if not isinstance(config, dict):
+            raise RuntimeError("Ошибка загрузки конфигурации клавиатур: ожидается объект с меню")
+        static, templates, texts = {}, {}, {}
+        for menu_name, menu_config in config.items():
+            rows = self._validate_menu(menu_name, menu_config)
+            texts[menu_name] = menu_config.get("text", "")
+            parametrized = any(
+                _has_placeholders(btn["text"]) or _has_placeholders(btn.get("url", ""))
+                for row in rows for btn in row
+            )
+            if parametrized:
+                templates[menu_name] = rows
+            else:
+                static[menu_name] = self._build(rows)
+        return static, templates, texts, self._compile_routes(config, static)
+
+    def _compile_routes(self, config: dict, static: dict) -> dict:
+        # Кнопка ведет в меню из поля menu, иначе по соглашению: "back" -> main_menu, "<x>" -> "<x>_menu".
+        # Меню с подстановками требуют параметров от кода и в таблицу не попадают
+        routes = {}
+        for menu_name, menu_config in config.items():
+            for row in menu_config["buttons"]:
+                for btn in row:
+                    if "callback_data" not in btn:
+                        continue
+                    data = str(btn["callback_data"])
+                    if "menu" in btn:
+                        target = btn["menu"]
+                        if target not in config:
+                            raise ValueError(f"Меню {menu_name}: кнопка {btn['text']!r} ведет в несуществующее меню {target!r}")
+                    elif data == self.BACK_CALLBACK:
+                        target = self.MAIN_MENU
+                    else:
+                        target = f"{data}_menu"
+                    if target in static:
+                        routes[data] = target
+        return routes
+
+    def get_markup(self, menu_name: str, **kwargs) -> InlineKeyboardMarkup:
+        # Возвращает общий для всех пользователей объект из кэша: модели aiogram 3.0.0 не заморожены,
+        # а inline_keyboard — изменяемый список списков. Менять результат нельзя (это изменит меню
+        # у всех до /reload); для правок сделайте копию: markup.model_copy(deep=True)
+        markup = self._static.get(menu_name)
+        if markup is not None:
+            return markup
+        rows = self._templates.get(menu_name)
+        if rows is None:
+            raise ValueError(f"Меню {menu_name} не найдено в конфигурации")
+        try:
+            key = (menu_name, frozenset(kwargs.items()))
+            hash(key)
+        except TypeError:
+            return self._build(rows, **kwargs)
+        markup = self._param_cache.get(key)
+        if markup is None:
+            markup = self._build(rows, **kwargs)
+            self._param_cache[key] = markup
+            while len(self._param_cache) > KEYBOARD_CACHE_SIZE:
+                self._param_cache.popitem(last=False)
+        else:
+            self._param_cache.move_to_end(key)
+        return markup
+
     def get_menu_text(self, menu_name: str) -> str:
-        return self.config.get(menu_name, {}).get("text", "")
+        return self._texts.get(menu_name, "")
+
+    def route(self, callback_data: str):
+        return self._routes.get(callback_data)
 
     def reload_config(self):
-        self.config = self._load_config()
+        config = self._load_config()
+        static, templates, texts, routes = self._compile(config)
+        # Подменяем все разом, между await-ами состояние всегда согласовано
+        self.config = config
+        self._static, self._templates, self._texts = static, templates, texts
+        self._routes = routes
+        self._param_cache = OrderedDict()
 
 keyboard_manager = KeyboardManager()
 
@@ -204,7 +1783,7 @@ async def cmd_menu(message: types.Message, state: FSMContext):
 async def cmd_help(message: types.Message):
     user_id = message.from_user.id
     is_admin = user_id in ADMIN_IDS
-    help_text = Texts.HELP + ("\nАдмин-команды:\n/stats - Статистика\n/reload - Обновить конфиг" if is_admin else "")
+    help_text = Texts.HELP + (Texts.ADMIN_HELP if is_admin else "")
     await message.answer(help_text)
 
 @router.message(Command("stats"))
@@ -212,8 +1791,32 @@ async def cmd_stats(message: types.Message):
     if message.from_user.id not in ADMIN_IDS:
         await message.answer("❌ Нет прав.")
         return
-    total, active = await db.get_stats()
-    await message.answer(f"📊 Пользователей: {total}\nАктивных: {active}")
+    stats = await db.get_stats()
+    daily = await db.get_daily_stats(7)
+    total = stats["users_total"]
+    at_quota_share = stats["users_at_quota"] / total * 100 if total else 0.0
+    daily_lines = "".join(
+        f"  {day}: новых {values.get('new_users', 0)}, вопросов {values.get('questions', 0)}\n"
+        for day, values in daily.items()
+    )
+    llm = llm_client.stats
+    scheduler = llm_scheduler.stats
+    cache = answer_cache.stats
+    queue = update_queue.stats
+    avg_wait = queue["wait_sum"] / queue["processed"] if queue["processed"] else 0.0
+    await message.answer(
+        f"📊 Пользователей: {total}\nАктивных: {stats['users_subscribed']}\n"
+        f"🚫 Исчерпали лимит: {stats['users_at_quota']} ({at_quota_share:.1f}%)\n"
+        f"📅 За 7 дней:\n{daily_lines}"
+        f"🤖 Запросов к нейросети: {llm['requests']} (повторов: {llm['retries']}, ошибок: {llm['errors']})\n"
+        f"🚦 Планировщик: в работе {llm_scheduler.running}, в очереди {llm_scheduler.depth}, "
+        f"склеено {scheduler['coalesced']}, отменено по дедлайну {scheduler['expired']}\n"
+        f"🔌 Соединений: новых {llm['connections_created']}, переиспользовано {llm['connections_reused']}\n"
+        f"🗂 Кэш ответов: попаданий {cache['hits']} (из БД: {cache['db_hits']}), промахов {cache['misses']}\n"
+        f"📥 Очередь апдейтов: {update_queue.depth} (макс. {queue['max_depth']}), "
+        f"ожидание ср. {avg_wait:.2f} с / макс. {queue['wait_max']:.2f} с, "
+        f"дубликатов {queue['duplicates']}, отклонено {queue['shed']}"
+    )
 
 @router.message(Command("reload"))
 async def cmd_reload(message: types.Message):
@@ -226,122 +1829,952 @@ async def cmd_reload(message: types.Message):
     except Exception as e:
         await message.answer(f"❌ Ошибка: {str(e)}")
 
-# Обработчики колбэков
-@router.callback_query(F.data.in_({"credit_cards", "loans", "education", "insurance", "jobs", "online_shops", "promotions", "ask_neuro"}))
-async def handle_category(callback: types.CallbackQuery):
-    menu_name = f"{callback.data}_menu"
-    await callback.message.edit_text(
-        keyboard_manager.get_menu_text(menu_name),
-        reply_markup=keyboard_manager.get_markup(menu_name)
-    )
+@router.message(Command("broadcast"))
+async def cmd_broadcast(message: types.Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ Нет прав.")
+        return
+    source = message.reply_to_message
+    if source is not None:
+        broadcast_id = await broadcasts.create(message.chat.id, from_chat_id=source.chat.id, message_id=source.message_id)
+    elif command.args:
+        broadcast_id = await broadcasts.create(message.chat.id, text=command.args)
+    else:
+        await message.answer("Укажите текст: /broadcast текст — или ответьте командой на сообщение.")
+        return
+    await message.answer(f"✅ Рассылка #{broadcast_id} запущена.")
 
-@router.callback_query(F.data == "back")
-async def back_handler(callback: types.CallbackQuery):
-    await callback.message.edit_text(
-        keyboard_manager.get_menu_text("main_menu"),
-        reply_markup=keyboard_manager.get_markup("main_menu")
-    )
+@router.message(Command("broadcast_status"))
+async def cmd_broadcast_status(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ Нет прав.")
+        return
+    active = await db.get_active_broadcasts()
+    if not active:
+        await message.answer("Активных рассылок нет.")
+        return
+    lines = []
+    for broadcast_id in active:
+        job = await db.get_broadcast(broadcast_id)
+        lines.append(
+            f"#{broadcast_id}: отправлено {job['sent']}, ошибок {job['failed']}, "
+            f"заблокировали {job['blocked']}, последний user_id {job['last_user_id']}"
+        )
+    await message.answer("📣 Рассылки:\n" + "\n".join(lines))
 
+@router.message(Command("broadcast_cancel"))
+async def cmd_broadcast_cancel(message: types.Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ Нет прав.")
+        return
+    if not command.args or not command.args.strip().isdigit():
+        await message.answer("Укажите номер: /broadcast_cancel id")
+        return
+    await broadcasts.cancel(int(command.args.strip()))
+    await message.answer("✅ Рассылка отменена.")
+
+@router.message(Command("purge_cache"))
+async def cmd_purge_cache(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ Нет прав.")
+        return
+    try:
+        await answer_cache.purge()
+        await message.answer("✅ Кэш ответов очищен!")
+    except Exception as e:
+        await message.answer(f"❌ Ошибка: {str(e)}")
+
+# Обработчики колбэков
 @router.callback_query(F.data == "ask_neuro")
 async def ask_neuro_handler(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
-    # Для обычных пользователей можно добавить проверку подписки, если нужно:
+    # Для обычных пользователей проверяем подписку (результат кэшируется)
     if user_id not in ADMIN_IDS:
-        member = await bot.get_chat_member(CHANNEL_ID, user_id)
-        if member.status not in ["member", "administrator", "creator"]:
+        if not await subscriptions.is_subscribed(user_id):
             await callback.answer("📢 Подпишитесь на канал!", show_alert=True)
             return
     await callback.message.answer("Введите вопрос:")
     await state.set_state(Form.ask_neuro)
+    # Новый вход в режим вопросов начинает диалог заново
+    await conversations.reset(state)
+
+# Переходы по меню строятся из keyboards_config.json и подменяются при /reload.
+# Обработчик регистрируется после колбэков с собственной логикой (ask_neuro и т.п.),
+# поэтому одноименное меню в конфиге их не перекрывает
+def menu_route(callback: types.CallbackQuery):
+    menu_name = keyboard_manager.route(callback.data)
+    return {"menu_name": menu_name} if menu_name else False
+
+@router.callback_query(menu_route)
+async def handle_menu(callback: types.CallbackQuery, menu_name: str):
+    message = callback.message
+    if message is None:
+        return
+    text = keyboard_manager.get_menu_text(menu_name)
+    markup = keyboard_manager.get_markup(menu_name)
+    # Сообщение уже показывает это меню — правка не нужна. Сравниваем поля, а не модели:
+    # у входящей разметки есть приватная ссылка на бота, из-за которой == всегда ложно
+    shown = message.reply_markup
+    if message.text == text and shown is not None and shown.model_dump() == markup.model_dump():
+        metrics.inc("bot_menu_edits_skipped_total")
+        return
+    try:
+        await message.edit_text(text, reply_markup=markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+
+metrics.describe("bot_menu_edits_skipped_total", "counter", "Пропущенные правки меню без изменений")
+
+# Разбиение длинного текста на сообщения в пределах лимита Telegram
+def _split_point(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> int:
+    if len(text) <= limit:
+        return len(text)
+    for sep in ("\n\n", "\n", " "):
+        cut = text.rfind(sep, limit // 2, limit)
+        if cut > 0:
+            return cut + len(sep)
+    return limit
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    parts = []
+    while len(text) > limit:
+        cut = _split_point(text, limit)
+        parts.append(text[:cut])
+        text = text[cut:]
+    parts.append(text)
+    return parts
+
+class StreamingReply:
+    # Ответ, который дописывается правками сообщения не чаще STREAM_EDIT_INTERVAL;
+    # при превышении лимита Telegram продолжается новым сообщением
+    def __init__(self, origin: types.Message, prefix: str = ""):
+        self.origin = origin
+        self.buffer = prefix
+        self.received = False
+        self.message = None
+        self.shown = None
+        self.last_edit = 0.0
+
+    async def start(self, placeholder: str = "…"):
+        self.message = await self.origin.answer(self.buffer + placeholder)
+        self.shown = self.buffer + placeholder
+        self.last_edit = time.monotonic()
+
+    async def _show(self, text: str, final: bool = False):
+        # final — правка, после которой текст сообщения больше не меняется
+        # (окончание ответа или голова перед переносом): ее нельзя пропускать
+        if not text or text == self.shown:
+            return
+        while True:
+            try:
+                await self.message.edit_text(text)
+                self.shown = text
+            except TelegramRetryAfter as e:
+                if final:
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                # Пропускаем промежуточную правку, финальная будет отправлена с ожиданием
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    raise
+            break
+        self.last_edit = time.monotonic()
+
+    async def _append(self, text: str) -> bool:
+        self.buffer += text
+        split = False
+        while len(self.buffer) > TELEGRAM_MESSAGE_LIMIT:
+            cut = _split_point(self.buffer)
+            head, self.buffer = self.buffer[:cut], self.buffer[cut:]
+            await self._show(head, final=True)
+            self.message = await self.origin.answer("…")
+            self.shown = "…"
+            split = True
+        return split
+
+    async def feed(self, chunk: str):
+        self.received = self.received or bool(chunk)
+        split = await self._append(chunk)
+        if split or time.monotonic() - self.last_edit >= STREAM_EDIT_INTERVAL:
+            await self._show(self.buffer)
+
+    async def finish(self, suffix: str = ""):
+        await self._append(suffix)
+        await self._show(self.buffer, final=True)
 
 @router.message(Form.ask_neuro)
 async def process_neuro_question(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     is_admin = user_id in ADMIN_IDS
-    # Для обычных пользователей проверяем лимит (5 запросов)
-    if not is_admin:
-        count = await db.get_question_count(user_id)
-        if count >= 5:
-            await message.answer("❌ Лимит вопросов исчерпан.")
-            await state.clear()  # Выходим из режима вопросов
+    # Общий лимит одновременных запросов к нейросети проверяем до списания вопроса
+    if not flood_control.try_acquire_llm():
+        metrics.inc("bot_flood_rejected_total", kind="llm")
+        await message.answer(Texts.LLM_BUSY)
+        return
+    try:
+        await _answer_neuro_question(message, state, user_id, is_admin)
+    finally:
+        flood_control.release_llm()
+
+async def _answer_neuro_question(message: types.Message, state: FSMContext, user_id: int, is_admin: bool):
+    # Проверка лимита и списание вопроса одной атомарной операцией (лимиты задаются по ролям)
+    if not await quota.try_consume(user_id):
+        await message.answer("❌ Лимит вопросов исчерпан.")
+        await state.clear()  # Выходим из режима вопросов
+        return
+    role = "admin" if is_admin else "user"
+    context = await conversations.messages(state)
+    # Получаем ответ от нейросети с учетом роли и предыдущих реплик
+    if LLM_STREAM:
+        reply = StreamingReply(message, "🤖 Ответ:\n")
+        await reply.start()
+        chunks = []
+        try:
+            async for chunk in stream_neuro_answer(message.text, is_admin=is_admin, context=context):
+                chunks.append(chunk)
+                await reply.feed(chunk)
+        except NeuroError as e:
+            if not reply.received:
+                # Ошибка или таймаут нейросети не должны сжигать вопрос пользователя
+                await quota.refund(user_id)
+                await reply.message.edit_text(str(e))
+            else:
+                await reply.finish(f"\n\n{e}")
             return
+        if not reply.received:
+            await reply.finish("Нет ответа.")
         else:
-            await db.increment_question_count(user_id)
-    # Получаем ответ от нейросети с учетом роли
-    answer = await get_neuro_answer(message.text, is_admin=is_admin)
-    await message.answer(f"🤖 Ответ:\n{answer}")
+            await reply.finish()
+            await conversations.append(state, role, message.text, "".join(chunks))
+        return
+    try:
+        answer = await get_neuro_answer(message.text, is_admin=is_admin, context=context)
+    except NeuroError as e:
+        # Ошибка или таймаут нейросети не должны сжигать вопрос пользователя
+        await quota.refund(user_id)
+        await message.answer(str(e))
+        return
+    for part in split_message(f"🤖 Ответ:\n{answer}"):
+        await message.answer(part)
+    await conversations.append(state, role, message.text, answer)
     # Состояние не сбрасывается, чтобы пользователь мог продолжать задавать вопросы до исчерпания лимита
 
 # Функция для запроса к нейросети (Claude API)
-async def get_neuro_answer(question: str, is_admin: bool = False):
-    headers = {
-        "Authorization": f"Bearer {CLAUDE_API_KEY}",
-        "Content-Type": "application/json"
-    }
+class NeuroError(Exception):
+    # Текст исключения показывается пользователю
+    pass
+
+# Клиент нейросети: одна сессия с keep-alive пулом на все приложение
+class LLMClient:
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, url: str = None, api_key: str = None):
+        self.url = url or CLAUDE_API_URL
+        self.api_key = api_key or CLAUDE_API_KEY
+        self._session = None
+        self.stats = {
+            "requests": 0,
+            "retries": 0,
+            "errors": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+            "streams": 0,
+            "ttft_sum": 0.0,
+        }
+
+    def _trace_config(self):
+        trace = aiohttp.TraceConfig()
+
+        async def on_create(session, ctx, params):
+            self.stats["connections_created"] += 1
+
+        async def on_reuse(session, ctx, params):
+            self.stats["connections_reused"] += 1
+
+        trace.on_connection_create_end.append(on_create)
+        trace.on_connection_reuseconn.append(on_reuse)
+        return trace
+
+    def _ensure_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=LLM_POOL_SIZE,
+                keepalive_timeout=LLM_KEEPALIVE,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json"
+                },
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    sock_connect=LLM_CONNECT_TIMEOUT,
+                    sock_read=LLM_READ_TIMEOUT
+                ),
+                trace_configs=[self._trace_config()]
+            )
+        return self._session
+
+    async def start(self):
+        self._ensure_session()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _retry_delay(self, attempt: int, retry_after: str = None) -> float:
+        if retry_after:
+            try:
+                return max(float(retry_after), 0.0)
+            except ValueError:
+                try:
+                    moment = parsedate_to_datetime(retry_after)
+                    return max((moment - datetime.now(timezone.utc)).total_seconds(), 0.0)
+                except (TypeError, ValueError):
+                    pass
+        # Экспоненциальная задержка с полным джиттером
+        return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+    async def post(self, payload: dict):
+        # Возвращает открытый ответ со статусом 200; вызывающий закрывает его через async with
+        session = self._ensure_session()
+        attempt = 0
+        while True:
+            self.stats["requests"] += 1
+            try:
+                response = await session.post(self.url, json=payload)
+            except asyncio.TimeoutError:
+                self.stats["errors"] += 1
+                raise
+            except aiohttp.ClientConnectionError:
+                if attempt >= LLM_MAX_RETRIES:
+                    self.stats["errors"] += 1
+                    raise
+                delay = self._retry_delay(attempt)
+            else:
+                if response.status == 200:
+                    return response
+                error = await response.text()
+                response.release()
+                if response.status not in self.RETRY_STATUSES or attempt >= LLM_MAX_RETRIES:
+                    self.stats["errors"] += 1
+                    logger.error(f"Claude API Error: {response.status} - {error}")
+                    raise NeuroError("⚠️ Ошибка нейросети.")
+                delay = self._retry_delay(attempt, response.headers.get("Retry-After"))
+                if delay > LLM_BACKOFF_MAX:
+                    # Ждать дольше нельзя: висели бы обработчик, слот планировщика и вопрос пользователя
+                    self.stats["errors"] += 1
+                    logger.warning(f"Claude API {response.status}: Retry-After {delay:.0f} с больше LLM_BACKOFF_MAX, отказ")
+                    raise NeuroError(Texts.LLM_BUSY)
+                logger.warning(f"Claude API {response.status}, повтор через {delay:.1f} с")
+            attempt += 1
+            self.stats["retries"] += 1
+            await asyncio.sleep(delay)
+
+    async def complete(self, payload: dict) -> dict:
+        response = await self.post(payload)
+        async with response:
+            return await response.json()
+
+    async def stream(self, payload: dict):
+        # Отдает фрагменты текста из SSE-ответа (формат chat/completions со stream: true)
+        started = time.monotonic()
+        response = await self.post({**payload, "stream": True})
+        async with response:
+            self.stats["streams"] += 1
+            first = True
+            if response.content_type != "text/event-stream":
+                # Прокси вернул обычный JSON — отдаем ответ целиком
+                result = await response.json()
+                yield result.get("choices", [{}])[0].get("message", {}).get("content", "")
+                return
+            async for raw_line in response.content:
+                line = raw_line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                try:
+                    event = json.loads(data)
+                except ValueError:
+                    continue
+                choice = (event.get("choices") or [{}])[0]
+                chunk = (choice.get("delta") or choice.get("message") or {}).get("content")
+                if not chunk:
+                    continue
+                if first:
+                    first = False
+                    self.stats["ttft_sum"] += time.monotonic() - started
+                yield chunk
+
+llm_client = LLMClient()
+
+# Один потоковый ответ нейросети, который читают все подписчики с одинаковым вопросом
+class _SharedStream:
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def push(self, chunk: str):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def close(self, error: BaseException = None):
+        self.error = error
+        self.done = True
+        self._notify()
+
+    async def subscribe(self):
+        # Поздний подписчик сначала получает уже накопленные фрагменты
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+# Планировщик запросов к нейросети: не больше LLM_CONCURRENCY запросов одновременно,
+# администраторы обслуживаются первыми, но занимают не больше LLM_ADMIN_CONCURRENCY слотов,
+# чтобы длинные запросы на 4000 токенов не вытесняли короткие пользовательские
+class LLMScheduler:
+    PRIORITIES = ("admin", "user")
+
+    def __init__(self, concurrency: int = None, admin_concurrency: int = None, queue_timeout: float = None):
+        self.concurrency = concurrency or LLM_CONCURRENCY
+        self.limits = {
+            "admin": min(admin_concurrency or LLM_ADMIN_CONCURRENCY, self.concurrency),
+            "user": self.concurrency,
+        }
+        self.queue_timeout = queue_timeout or LLM_QUEUE_TIMEOUT
+        self.active = {priority: 0 for priority in self.PRIORITIES}
+        # priority -> deque[(future, deadline)]
+        self._queues = {priority: deque() for priority in self.PRIORITIES}
+        # Одинаковые запросы в полете: ("call" | "stream", key) -> задача или _SharedStream
+        self._inflight = {}
+        self.stats = {"scheduled": 0, "queued": 0, "coalesced": 0, "expired": 0}
+
+    @property
+    def running(self) -> int:
+        return sum(self.active.values())
+
+    @property
+    def depth(self) -> int:
+        return sum(len(waiters) for waiters in self._queues.values())
+
+    def _can_run(self, priority: str) -> bool:
+        return self.running < self.concurrency and self.active[priority] < self.limits[priority]
+
+    def _wake(self):
+        # Раздает свободные слоты по приоритету; просроченные ожидания отменяются без запроса
+        now = time.monotonic()
+        for priority in self.PRIORITIES:
+            waiters = self._queues[priority]
+            while waiters and self._can_run(priority):
+                future, deadline = waiters.popleft()
+                if future.done():
+                    continue
+                if deadline <= now:
+                    self.stats["expired"] += 1
+                    future.set_exception(NeuroError(Texts.LLM_BUSY))
+                    continue
+                self.active[priority] += 1
+                future.set_result(None)
+
+    async def acquire(self, priority: str, deadline: float = None):
+        started = time.monotonic()
+        deadline = deadline or started + self.queue_timeout
+        self.stats["scheduled"] += 1
+        if not self._queues[priority] and self._can_run(priority):
+            self.active[priority] += 1
+            metrics.observe("bot_llm_queue_wait_seconds", 0.0, priority=priority)
+            return
+        self.stats["queued"] += 1
+        entry = (asyncio.get_running_loop().create_future(), deadline)
+        self._queues[priority].append(entry)
+        future = entry[0]
+        try:
+            await asyncio.wait_for(future, max(deadline - time.monotonic(), 0.0))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # Слот выдан одновременно с отменой — возвращаем его
+                self.release(priority)
+            elif entry in self._queues[priority]:
+                self._queues[priority].remove(entry)
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats["expired"] += 1
+                raise NeuroError(Texts.LLM_BUSY)
+            raise
+        finally:
+            metrics.observe("bot_llm_queue_wait_seconds", time.monotonic() - started, priority=priority)
+
+    def release(self, priority: str):
+        self.active[priority] -= 1
+        self._wake()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: str, deadline: float = None):
+        await self.acquire(priority, deadline)
+        started = time.perf_counter()
+        status = "error"
+        try:
+            yield
+            status = "ok"
+        finally:
+            self.release(priority)
+            metrics.observe("bot_llm_upstream_seconds", time.perf_counter() - started, priority=priority, status=status)
+
+    async def call(self, key: str, priority: str, factory):
+        # factory() — корутина запроса к нейросети; одинаковые запросы в полете выполняются один раз
+        task = self._inflight.get(("call", key))
+        if task is None:
+            task = asyncio.create_task(self._run_call(priority, factory))
+            self._inflight[("call", key)] = task
+            task.add_done_callback(lambda _: self._inflight.pop(("call", key), None))
+        else:
+            self.stats["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    async def _run_call(self, priority: str, factory):
+        async with self.slot(priority):
+            return await factory()
+
+    async def stream(self, key: str, priority: str, factory):
+        # factory() — асинхронный генератор фрагментов; чтение идет в отдельной задаче,
+        # поэтому уход одного подписчика не обрывает ответ остальным
+        shared = self._inflight.get(("stream", key))
+        if shared is None:
+            shared = _SharedStream()
+            self._inflight[("stream", key)] = shared
+            shared.task = asyncio.create_task(self._run_stream(shared, priority, factory))
+            shared.task.add_done_callback(lambda _: self._inflight.pop(("stream", key), None))
+        else:
+            self.stats["coalesced"] += 1
+        async for chunk in shared.subscribe():
+            yield chunk
+
+    async def _run_stream(self, shared: _SharedStream, priority: str, factory):
+        try:
+            async with self.slot(priority):
+                async for chunk in factory():
+                    shared.push(chunk)
+        except Exception as e:
+            shared.close(e)
+        else:
+            shared.close()
+
+metrics.describe("bot_llm_queue_wait_seconds", "histogram", "Ожидание слота планировщика нейросети")
+metrics.describe("bot_llm_upstream_seconds", "histogram", "Время запроса к нейросети без ожидания в очереди")
+llm_scheduler = LLMScheduler()
+
+# Кэш ответов на повторяющиеся вопросы
+class AnswerCache:
+    def __init__(self, database: Database = None):
+        self.db = database
+        # key -> (answer, expires_at)
+        self._entries = OrderedDict()
+        self.stats = {"hits": 0, "db_hits": 0, "misses": 0}
+        self._last_expire = time.monotonic()
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        text = " ".join((question or "").lower().replace("ё", "е").split())
+        return text.strip(" ?!.,;:")
+
+    def key(self, question: str, model: str, max_tokens: int) -> str:
+        raw = f"{model}\x00{max_tokens}\x00{self.normalize(question)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, answer: str, expires_at: float):
+        self._entries[key] = (answer, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > ANSWER_CACHE_SIZE:
+            self._entries.popitem(last=False)
+
+    async def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is not None:
+            answer, expires_at = entry
+            if expires_at >= time.monotonic():
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return answer
+            del self._entries[key]
+        if self.db is not None and ANSWER_CACHE_PERSIST:
+            try:
+                row = await self.db.get_cached_answer(key)
+            except Exception as e:
+                logger.error(f"Ошибка чтения кэша ответов: {str(e)}")
+                row = None
+            if row is not None:
+                answer, created_at = row
+                age = time.time() - created_at
+                if age < ANSWER_CACHE_TTL:
+                    self._remember(key, answer, time.monotonic() + ANSWER_CACHE_TTL - age)
+                    self.stats["db_hits"] += 1
+                    return answer
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, key: str, answer: str):
+        if not answer:
+            return
+        self._remember(key, answer, time.monotonic() + ANSWER_CACHE_TTL)
+        if self.db is not None and ANSWER_CACHE_PERSIST:
+            try:
+                await self.db.put_cached_answer(key, answer)
+                # Таблица растет только при записи, поэтому и чистим ее здесь
+                if time.monotonic() - self._last_expire > ANSWER_CACHE_EXPIRE_INTERVAL:
+                    self._last_expire = time.monotonic()
+                    await self.db.expire_cached_answers(ANSWER_CACHE_TTL, ANSWER_CACHE_DB_SIZE)
+            except Exception as e:
+                logger.error(f"Ошибка записи кэша ответов: {str(e)}")
+
+    async def purge(self):
+        self._entries.clear()
+        if self.db is not None:
+            await self.db.purge_cached_answers()
+
+answer_cache = AnswerCache(db)
+
+def _neuro_payload(question: str, is_admin: bool, context: list = None) -> dict:
     # Для обычных пользователей лимит = 200, для администраторов = 4000
     max_tokens = 4000 if is_admin else 200
-    data = {
+    return {
         "model": CLAUDE_MODEL,
-        "messages": [{"role": "user", "content": question}],
+        "messages": (context or []) + [{"role": "user", "content": question}],
         "max_tokens": max_tokens
     }
+
+def _answer_key(data: dict) -> str:
+    if len(data["messages"]) == 1:
+        return answer_cache.key(data["messages"][0]["content"], data["model"], data["max_tokens"])
+    # Ответ с контекстом диалога зависит от всей переписки (ключ нужен только для склейки запросов)
+    raw = json.dumps([data["model"], data["max_tokens"], data["messages"]], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+@timed("bot_llm_request_seconds", "call")
+async def get_neuro_answer(question: str, is_admin: bool = False, context: list = None):
+    data = _neuro_payload(question, is_admin, context)
+    key = _answer_key(data)
+    # В кэше только ответы на вопросы без контекста
+    cacheable = not context
+    if cacheable:
+        cached = await answer_cache.get(key)
+        if cached is not None:
+            return cached
+
+    async def request():
+        result = await llm_client.complete(data)
+        answer = result.get("choices", [{}])[0].get("message", {}).get("content")
+        if answer and cacheable:
+            await answer_cache.put(key, answer)
+        return answer
+
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                CLAUDE_API_URL,
-                headers=headers,
-                json=data,
-                timeout=30
-            ) as response:
-                if response.status != 200:
-                    error = await response.text()
-                    logger.error(f"Claude API Error: {response.status} - {error}")
-                    return "⚠️ Ошибка нейросети."
-                result = await response.json()
-                return result.get("choices", [{}])[0].get("message", {}).get("content", "Нет ответа.")
+        answer = await llm_scheduler.call(key, "admin" if is_admin else "user", request)
+        return answer or "Нет ответа."
     except asyncio.TimeoutError:
         logger.error("Claude API Timeout")
-        return "⌛ Таймаут."
+        raise NeuroError("⌛ Таймаут.")
+    except NeuroError:
+        raise
     except Exception as e:
         logger.error(f"Claude Error: {str(e)}")
-        return "⚠️ Ошибка."
+        raise NeuroError("⚠️ Ошибка.")
+
+async def stream_neuro_answer(question: str, is_admin: bool = False, context: list = None):
+    # Потоковый вариант get_neuro_answer: отдает текст по мере генерации
+    data = _neuro_payload(question, is_admin, context)
+    key = _answer_key(data)
+    cacheable = not context
+    if cacheable:
+        cached = await answer_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+    async def request():
+        chunks = []
+        async for chunk in llm_client.stream(data):
+            chunks.append(chunk)
+            yield chunk
+        # В кэш попадает только полностью полученный ответ
+        if cacheable:
+            await answer_cache.put(key, "".join(chunks))
+
+    started = time.perf_counter()
+    status = "error"
+    try:
+        async for chunk in llm_scheduler.stream(key, "admin" if is_admin else "user", request):
+            yield chunk
+        status = "ok"
+    except asyncio.TimeoutError:
+        logger.error("Claude API Timeout")
+        raise NeuroError("⌛ Таймаут.")
+    except NeuroError:
+        raise
+    except Exception as e:
+        logger.error(f"Claude Error: {str(e)}")
+        raise NeuroError("⚠️ Ошибка.")
+    finally:
+        metrics.observe("bot_llm_request_seconds", time.perf_counter() - started, call="stream_neuro_answer", status=status)
+
+# Очередь апдейтов: порядок внутри одного чата сохраняется, разные чаты обрабатываются параллельно
+def _order_key(update: types.Update):
+    try:
+        event = update.event
+    except UpdateTypeLookupError:
+        return ("update", update.update_id)
+    chat = getattr(event, "chat", None)
+    if chat is None and getattr(event, "message", None) is not None:
+        chat = event.message.chat
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    return ("update", update.update_id)
+
+class UpdateQueue:
+    def __init__(self, workers: int = None, maxsize: int = None, overflow: str = None):
+        self.workers = workers or DISPATCH_WORKERS
+        self.maxsize = maxsize or DISPATCH_QUEUE_SIZE
+        self.overflow = overflow or DISPATCH_OVERFLOW
+        # chat -> очередь апдейтов; чат в словаре, пока его обрабатывает воркер или он ждет в _ready
+        self._chats = {}
+        self._ready = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.maxsize)
+        self._seen = OrderedDict()
+        self._tasks = []
+        self._size = 0
+        self._busy = 0
+        self.stats = {
+            "accepted": 0,
+            "processed": 0,
+            "failed": 0,
+            "duplicates": 0,
+            "shed": 0,
+            "max_depth": 0,
+            "wait_sum": 0.0,
+            "wait_max": 0.0,
+        }
+
+    @property
+    def depth(self) -> int:
+        return self._size
+
+    async def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 30):
+        # Дожидаемся обработки уже принятых апдейтов, затем останавливаем воркеров
+        deadline = time.monotonic() + timeout
+        while (self._size or self._busy) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def put(self, update: types.Update) -> bool:
+        # False — очередь переполнена, апдейт не принят (Telegram повторит его позже)
+        if update.update_id in self._seen:
+            self.stats["duplicates"] += 1
+            return True
+        if self.overflow == "shed" and self._slots.locked():
+            self.stats["shed"] += 1
+            return False
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=DISPATCH_PUT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats["shed"] += 1
+            return False
+        if update.update_id in self._seen:
+            # Дубликат успел прийти, пока ждали места
+            self._slots.release()
+            self.stats["duplicates"] += 1
+            return True
+        self._seen[update.update_id] = None
+        while len(self._seen) > DISPATCH_DEDUP_WINDOW:
+            self._seen.popitem(last=False)
+        key = _order_key(update)
+        pending = self._chats.get(key)
+        if pending is None:
+            pending = self._chats[key] = deque()
+            self._ready.put_nowait(key)
+        pending.append((update, time.monotonic()))
+        self._size += 1
+        self.stats["accepted"] += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self._size)
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            pending = self._chats[key]
+            self._busy += 1
+            try:
+                while pending:
+                    update, enqueued_at = pending.popleft()
+                    self._size -= 1
+                    self._slots.release()
+                    waited = time.monotonic() - enqueued_at
+                    self.stats["wait_sum"] += waited
+                    self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+                    try:
+                        await dp.feed_update(bot, update)
+                        self.stats["processed"] += 1
+                    except Exception as e:
+                        self.stats["failed"] += 1
+                        logger.error(f"Ошибка обработки апдейта {update.update_id}: {str(e)}")
+            finally:
+                self._busy -= 1
+                del self._chats[key]
+
+update_queue = UpdateQueue()
+
+# Снимки счетчиков подсистем для /metrics
+def _collect_runtime_metrics(registry: Metrics):
+    for name, value in llm_client.stats.items():
+        registry.set("bot_llm_client", value, counter=name)
+    for name, value in answer_cache.stats.items():
+        registry.set("bot_answer_cache", value, counter=name)
+    for name, value in subscriptions.stats.items():
+        registry.set("bot_subscription_cache", value, counter=name)
+    for name, value in update_queue.stats.items():
+        registry.set("bot_update_queue", value, counter=name)
+    registry.set("bot_update_queue_depth", update_queue.depth)
+    registry.set("bot_flood_tracked_users", flood_control.tracked_users)
+    registry.set("bot_llm_active", flood_control.llm_active)
+    for name, value in llm_scheduler.stats.items():
+        registry.set("bot_llm_scheduler", value, counter=name)
+    registry.set("bot_llm_scheduler_depth", llm_scheduler.depth)
+    for priority, value in llm_scheduler.active.items():
+        registry.set("bot_llm_scheduler_running", value, priority=priority)
+
+metrics.describe("bot_llm_client", "gauge", "Счетчики клиента нейросети (запросы, повторы, соединения)")
+metrics.describe("bot_answer_cache", "gauge", "Счетчики кэша ответов")
+metrics.describe("bot_subscription_cache", "gauge", "Счетчики кэша подписки")
+metrics.describe("bot_update_queue", "gauge", "Счетчики очереди апдейтов")
+metrics.describe("bot_update_queue_depth", "gauge", "Текущая глубина очереди апдейтов")
+metrics.describe("bot_flood_tracked_users", "gauge", "Пользователи в таблице защиты от флуда")
+metrics.describe("bot_llm_active", "gauge", "Одновременные запросы к нейросети")
+metrics.describe("bot_llm_scheduler", "gauge", "Счетчики планировщика нейросети")
+metrics.describe("bot_llm_scheduler_depth", "gauge", "Запросы, ожидающие слота планировщика")
+metrics.describe("bot_llm_scheduler_running", "gauge", "Запросы к нейросети в работе по приоритетам")
+metrics.collect(_collect_runtime_metrics)
 
 # Веб-сервер
 async def health_check(request):
     return web.Response(text="OK")
 
+async def metrics_handler(request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+def parse_update(body: bytes) -> types.Update:
+    # Валидация сырых байтов сразу в модель, без промежуточных dict. Бот передается в контексте:
+    # иначе feed_update "перемонтирует" апдейт через model_dump() + model_validate()
+    return types.Update.model_validate_json(body, context={"bot": bot})
+
 async def webhook_handler(request):
-    data = await request.json()
-    update = types.Update(**data)
+    # Секрет проверяем до чтения и разбора тела
+    if WEBHOOK_SECRET:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode("utf-8"), WEBHOOK_SECRET.encode("utf-8")):
+            return web.Response(status=403)
+    if request.content_length is not None and request.content_length > WEBHOOK_MAX_BODY:
+        return web.Response(status=413)
+    # Тело без Content-Length ограничивает client_max_size приложения
+    body = await request.read()
+    try:
+        update = parse_update(body)
+    except ValidationError:
+        return web.Response(status=400)
+    try:
+        event_type = update.event_type
+    except UpdateTypeLookupError:
+        # Тип, которого нет в aiogram (например, chat_boost): диспетчер его проигнорирует,
+        # а 500 заставил бы Telegram повторять доставку
+        event_type = "unknown"
+    metrics.inc("bot_updates_total", type=event_type)
+    if DISPATCH_MODE == "queue":
+        # Подтверждаем webhook сразу, обработка идет в воркерах
+        if not await update_queue.put(update):
+            return web.Response(status=503)
+        return web.Response()
     await dp.feed_update(bot, update)
     return web.Response()
 
 # Основная функция запуска в режиме webhook
-async def main():
-    # Удаляем предыдущий webhook (если был установлен)
-    await bot.delete_webhook(drop_pending_updates=True)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "https://my-telegram-bot-yb0n.onrender.com/webhook")
+
+async def serve(manage_webhook: bool = True, reuse_port: bool = False):
+    if manage_webhook:
+        # Удаляем предыдущий webhook (если был установлен)
+        await bot.delete_webhook(drop_pending_updates=True)
     # Инициализация базы данных
     await db.init_db()
+    await db.expire_cached_answers(ANSWER_CACHE_TTL, ANSWER_CACHE_DB_SIZE)
+    await storage.start()
+    # Общая сессия для запросов к нейросети
+    await llm_client.start()
+    if DISPATCH_MODE == "queue":
+        await update_queue.start()
+    lag_task = asyncio.create_task(monitor_loop_lag())
+    # Незавершенные рассылки продолжаются с последнего чекпоинта
+    await broadcasts.resume()
     # Создаем веб-приложение aiohttp
-    app = web.Application()
+    app = web.Application(client_max_size=WEBHOOK_MAX_BODY)
     app.router.add_post("/webhook", webhook_handler)
     app.router.add_get("/health", health_check)
+    app.router.add_get("/metrics", metrics_handler)
     # Создаем и запускаем AppRunner и сайт
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, host="0.0.0.0", port=PORT)
+    site = web.TCPSite(runner, host="0.0.0.0", port=PORT, reuse_port=reuse_port)
     await site.start()
-    # Устанавливаем webhook (замените URL на ваш публичный домен)
-    webhook_url = "https://my-telegram-bot-yb0n.onrender.com/webhook"
-    await bot.set_webhook(webhook_url)
-    logger.info(f"Сервер запущен на порту {PORT}, webhook установлен: {webhook_url}")
+    if manage_webhook:
+        # Устанавливаем webhook (замените URL на ваш публичный домен)
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
+        logger.info(f"Сервер запущен на порту {PORT}, webhook установлен: {WEBHOOK_URL}")
+    else:
+        logger.info(f"Воркер {os.getpid()} слушает порт {PORT}")
     # Ожидание сигнала завершения работы
     stop_event = asyncio.Event()
+    stopping = False
     # Функция для graceful shutdown
     async def shutdown():
+        nonlocal stopping
+        if stopping:
+            return
+        stopping = True
         logger.info("Завершение работы...")
-        await bot.session.close()
+        # Сначала перестаем принимать апдейты, затем дорабатываем очередь
         await runner.cleanup()
+        lag_task.cancel()
+        await broadcasts.stop()
+        await update_queue.stop()
+        await bot.session.close()
+        await llm_client.close()
+        await storage.close()
+        await db.close()
         stop_event.set()
     # Регистрируем обработчики сигналов SIGINT и SIGTERM
     loop = asyncio.get_running_loop()
@@ -349,5 +2782,56 @@ async def main():
         loop.add_signal_handler(sig, lambda: asyncio.create_task(shutdown()))
     await stop_event.wait()
 
+async def main():
+    await serve()
+
+# Многопроцессный режим: N воркеров делят порт через SO_REUSEPORT,
+# webhook настраивает только родительский процесс
+async def _prepare_workers():
+    await bot.delete_webhook(drop_pending_updates=True)
+    # Схему создаем один раз до запуска воркеров; отдельный экземпляр, чтобы
+    # не привязывать объекты asyncio общего db к циклу родителя
+    schema_db = Database(write_behind=False)
+    await schema_db.init_db()
+    await schema_db.expire_cached_answers(ANSWER_CACHE_TTL, ANSWER_CACHE_DB_SIZE)
+    await schema_db.close()
+    await bot.session.close()
+
+async def _set_webhook():
+    await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
+    await bot.session.close()
+
+def _worker_main(index: int):
+    # Поток записи логов не переживает fork; каждому воркеру — свой файл, чтобы ротация не конфликтовала
+    root, ext = os.path.splitext(LOG_FILE)
+    setup_logging(f"{root}.worker{index}{ext}")
+    # Состояние FSM должно быть общим для всех процессов, поэтому без горячего слоя в памяти
+    storage.cache_ttl = 0
+    asyncio.run(serve(manage_webhook=False, reuse_port=True))
+
+def run_workers(workers: int = None):
+    workers = workers or WEB_WORKERS
+    asyncio.run(_prepare_workers())
+    ctx = multiprocessing.get_context("fork")
+    processes = [ctx.Process(target=_worker_main, args=(i,), name=f"worker-{i}") for i in range(workers)]
+    for process in processes:
+        process.start()
+    asyncio.run(_set_webhook())
+    logger.info(f"Запущено воркеров: {workers}, порт {PORT}, webhook установлен: {WEBHOOK_URL}")
+
+    # SIGINT/SIGTERM пересылаем воркерам, каждый завершается штатно через свой shutdown()
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    signal.signal(signal.SIGINT, forward)
+    signal.signal(signal.SIGTERM, forward)
+    for process in processes:
+        process.join()
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if WEB_WORKERS > 1:
+        run_workers()
+    else:
+        asyncio.run(main())